@@ -1,16 +1,32 @@
 import os
 import re
+import glob
 import json
 import shutil
 import logging
+import time
+import random
 import asyncio
+import bisect
+import itertools
+import weakref
+import hashlib
+import tempfile
+import subprocess
+from abc import ABC, abstractmethod
+import inspect
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from collections import defaultdict
+from xml.sax.saxutils import escape as escapar_xml
 from dotenv import load_dotenv
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
+from pydub.silence import split_on_silence, detect_nonsilent
+from pydub.utils import mediainfo
+import numpy as np
+import soundfile as sf
 import whisper
-from openai import OpenAI, AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 from rapidfuzz import fuzz, process
 from pathlib import Path
 import sys
@@ -40,9 +56,99 @@ class Util:
         """Convierte segundos a frames (por defecto 30fps)."""
         return int(float(segundos) * fps)
 
+    @staticmethod
+    def carpeta_cache(*subcarpetas) -> str:
+        """Devuelve (y crea) la carpeta de caché del usuario según el sistema operativo."""
+        if platform.system() == 'Windows':
+            base = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")), "SoundToXML", "Cache")
+        elif platform.system() == 'Darwin':
+            base = os.path.expanduser("~/Library/Caches/SoundToXML")
+        else:
+            base = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "sound_to_xml")
+        ruta = os.path.join(base, *subcarpetas)
+        os.makedirs(ruta, exist_ok=True)
+        return ruta
+
 # ============================================================
 # Clases de datos
 # ============================================================
+class ConfiguracionPipeline:
+    """Opciones del pipeline. Los valores por defecto reproducen el flujo clásico."""
+    def __init__(self, **opciones):
+        # Preparación del audio: "pydub" (flujo clásico), "memoria" (decodifica una única vez)
+        # o "ffmpeg" (un solo proceso de FFmpeg; el audio original nunca entra en Python)
+        self.modo_audio = "pydub"
+        # Parámetros de detección de silencios
+        self.min_silence_len = 500  # ms
+        self.silence_thresh = -40   # dB
+        self.keep_silence = 100     # ms a mantener
+        # Motor de detección de silencios: "pydub" o "numpy" (vectorizado)
+        self.motor_silencios = "pydub"
+        # Si es True no se renderiza audio sin silencios: Whisper trabaja sobre el audio
+        # concatenado en memoria y los tiempos se remapean al archivo original
+        self.silencios_no_destructivos = False
+        # Transcripción: motor ("whisper" o "ctranslate2"), modelo y número de procesos
+        # (1 = un solo modelo, sin trocear)
+        self.motor_transcripcion = os.getenv("MOTOR_TRANSCRIPCION", "whisper")
+        self.modelo_whisper = "small"
+        # Pesos int8 (None = lo que use el motor por defecto; en Whisper, una copia
+        # cuantizada y pre-serializada en la caché de usuario)
+        self.modelo_cuantizado = None
+        # Procesos de transcripción: un número o "auto" (según el presupuesto de hilos)
+        self.workers_transcripcion = 1
+        # Trabajos que comparten la máquina; reparte los núcleos entre ellos
+        self.trabajos_concurrentes = 1
+        # Duración de los fragmentos (s), cortados en pausas, y solape entre fragmentos vecinos
+        self.duracion_min_fragmento = 30
+        self.duracion_max_fragmento = 60
+        self.solape_fragmento = 0.5
+        # Caché de transcripciones en disco (clave: audio decodificado + parámetros)
+        self.cache_transcripciones = True
+        self.tamano_cache_transcripciones_mb = 500
+        # Formato de analysis/whisper_output: "json" (resultado completo de Whisper, legible) o
+        # "npz" (columnas de palabras y segmentos + cabecera JSON, compacto y de carga perezosa)
+        self.formato_transcripcion = "json"
+        # Tiempo máximo (s) de cada llamada a GPT
+        self.timeout_gpt = 300
+        # Segmentación en paralelo con el análisis del guion (solo el análisis visual espera a ambos)
+        self.pipeline_concurrente = False
+        # Límites compartidos por todas las llamadas a la API del proceso
+        self.max_peticiones_en_vuelo = 8
+        self.peticiones_por_minuto = 500
+        self.tokens_por_minuto = 150000
+        self.max_reintentos_gpt = 5
+        # Rondas extra para repetir solo los grupos de análisis visual que fallaron
+        self.rondas_reintento_grupos = 2
+        # Segmentos vecinos (antes y después) que recibe cada grupo del análisis visual como
+        # contexto; None envía el guion completo a cada grupo
+        self.ventana_contexto_segmentos = 8
+        # Presupuesto de tokens (segmentos del prompt + respuesta estimada) por grupo del análisis visual
+        self.tokens_por_grupo = 2500
+        self.tokens_respuesta_por_segmento = 150
+        # Segmentación por ventanas de palabras solapadas procesadas en paralelo (None: una sola petición)
+        self.palabras_por_ventana_segmentacion = 1500
+        self.solape_ventana_segmentacion = 100
+        # "texto": GPT devuelve el texto de cada segmento y se alinea con rapidfuzz;
+        # "indices": se envían las palabras numeradas y GPT devuelve solo dónde empieza cada segmento
+        self.protocolo_segmentacion = "texto"
+        # Palabras por delante de la última coincidencia en las que se buscan inicios de segmento (voraz)
+        self.ventana_busqueda_alineacion = 400
+        # "global": alineación DP en banda de todos los segmentos a la vez; "voraz": uno a uno con umbral
+        self.alineador = "global"
+        self.banda_alineacion = 200
+        # Recibir el análisis visual en streaming y notificar cada segmento en cuanto llega
+        self.streaming_gpt = False
+        # Caché de respuestas de GPT (clave: modelo, temperatura y mensajes). Con
+        # refrescar_cache_gpt se ignoran las entradas existentes pero se guardan las nuevas
+        self.cache_gpt = True
+        self.refrescar_cache_gpt = False
+        self.ttl_cache_gpt_horas = 24 * 7
+        self.tamano_cache_gpt_mb = 200
+        for clave, valor in opciones.items():
+            if not hasattr(self, clave):
+                raise ValueError(f"Opción de configuración desconocida: {clave}")
+            setattr(self, clave, valor)
+
 class Segmento:
     def __init__(self):
         self.texto = ""
@@ -64,9 +170,69 @@ class Segmento:
         }
         self.palabras_clave = []
 
+class Marcador:
+    """Marcador listo para exportar, calculado una vez por segmento y compartido por todos los
+    escritores (SRT, XML): campos ya formateados, textos XML ya escapados y frames ya calculados."""
+    __slots__ = ("numero", "texto", "tiempo_inicio", "tiempo_fin", "frame_inicio", "frame_fin",
+                 "descripcion_visual", "storyboard", "elementos_visuales", "palabras_clave",
+                 "nombre_xml", "comentario_xml")
+    LONGITUD_MAXIMA_NOMBRE = 100
+    # Entidades extra para atributos y contenido de marcadores (los saltos de línea como &#xA;)
+    ENTIDADES_XML = {'"': '&quot;', '\n': '&#xA;'}
+
+    def __init__(self, numero, segmento, fps=30):
+        self.numero = numero
+        self.texto = segmento.texto
+        self.tiempo_inicio = segmento.tiempo_inicio
+        self.tiempo_fin = segmento.tiempo_fin
+        self.frame_inicio = Util.segundos_a_frames(segmento.tiempo_inicio, fps)
+        self.frame_fin = max(Util.segundos_a_frames(segmento.tiempo_fin, fps), self.frame_inicio + 1)
+        self.descripcion_visual = segmento.descripcion_visual or ""
+        self.storyboard = segmento.storyboard or ""
+        # Solo las categorías visuales con contenido, como líneas "categoria: elemento";
+        # GPT a veces devuelve tipo_visual como texto o lista, que se ignora
+        tipo_visual = segmento.tipo_visual if isinstance(segmento.tipo_visual, dict) else {}
+        self.elementos_visuales = tuple(
+            f"{categoria}: {elemento}"
+            for categoria, valor in tipo_visual.items() if valor
+            for elemento in (valor if isinstance(valor, list) else [valor])
+        )
+        palabras_clave = segmento.palabras_clave
+        self.palabras_clave = ', '.join(map(str, palabras_clave)) if isinstance(palabras_clave, list) else (palabras_clave or "")
+
+        self.nombre_xml = escapar_xml(f"[{numero}] {self.descripcion_visual[:self.LONGITUD_MAXIMA_NOMBRE]}",
+                                      self.ENTIDADES_XML)
+        self.comentario_xml = escapar_xml(self.comentario(), self.ENTIDADES_XML)
+
+    def comentario(self, con_valores_por_defecto=False):
+        """Bloque de texto con la descripción del marcador (común al SRT y al XML)."""
+        if con_valores_por_defecto:
+            descripcion = self.descripcion_visual or "Sin descripción visual"
+            storyboard = self.storyboard or "Sin storyboard"
+            elementos = "\n".join(self.elementos_visuales) or "Sin elementos visuales"
+            palabras_clave = self.palabras_clave or "Sin palabras clave"
+        else:
+            descripcion, storyboard = self.descripcion_visual, self.storyboard
+            elementos, palabras_clave = "\n".join(self.elementos_visuales), self.palabras_clave
+        return f"""DESCRIPCIÓN VISUAL:
+{descripcion}
+
+STORYBOARD:
+{storyboard}
+
+TIPO VISUAL:
+{elementos}
+
+PALABRAS CLAVE:
+{palabras_clave}
+
+TEXTO:
+{self.texto}"""
+
 class ProyectoEdicion:
     def __init__(self):
         self.segmentos = []
+        self.marcadores = []
         self.metadata = {
             "titulo": "",
             "fecha": datetime.now().strftime("%Y-%m-%d"),
@@ -93,6 +259,11 @@ class ProyectoEdicion:
         self.metadata["num_segmentos"] = len(self.segmentos)
         if self.segmentos:
             self.metadata["duracion_total"] = max(seg.tiempo_fin for seg in self.segmentos)
+
+    def construir_marcadores(self, fps=30):
+        """Precalcula los marcadores de exportación a partir de los segmentos."""
+        self.marcadores = [Marcador(i, segmento, fps) for i, segmento in enumerate(self.segmentos, 1)]
+        return self.marcadores
     
     def guardar_prompt(self, fase, system_content, user_content, response_content):
         self.metadata["prompts"][fase] = {
@@ -101,14 +272,960 @@ class ProyectoEdicion:
             "response": response_content
         }
 
+# ============================================================
+# Audio decodificado una única vez en memoria
+# ============================================================
+class AudioDecodificado:
+    """PCM compartido por todo el pipeline: 16 kHz mono para Whisper y la detección
+    de silencios, y una copia a la frecuencia original reservada para el asset."""
+    SAMPLE_RATE_WHISPER = 16000
+
+    def __init__(self, ruta, pcm_16k, pcm_original, sample_rate):
+        self.ruta = ruta
+        self.pcm_16k = pcm_16k              # float32 (muestras,)
+        self.pcm_original = pcm_original    # int16 (muestras, canales)
+        self.sample_rate = sample_rate
+
+    @property
+    def duracion(self) -> float:
+        """Duración en segundos."""
+        return len(self.pcm_16k) / self.SAMPLE_RATE_WHISPER
+
+    @classmethod
+    def decodificar(cls, ruta, con_original=True):
+        """Decodifica el archivo con una sola invocación de FFmpeg que produce las dos versiones.
+        
+        Con con_original=False solo se obtiene el buffer de 16 kHz (no hace falta asset)."""
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            raise FileNotFoundError("FFmpeg debe estar instalado en el sistema.")
+        with tempfile.TemporaryDirectory() as carpeta_temp:
+            ruta_original = os.path.join(carpeta_temp, "original.wav")
+            comando = [
+                ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", ruta,
+                # Salida 1: 16 kHz mono float32 por stdout (lo mismo que espera Whisper)
+                "-map", "0:a:0", "-ac", "1", "-ar", str(cls.SAMPLE_RATE_WHISPER), "-f", "f32le", "pipe:1"
+            ]
+            if con_original:
+                # Salida 2: PCM sin pérdidas a la frecuencia original para el asset
+                comando += ["-map", "0:a:0", "-c:a", "pcm_s16le", "-rf64", "auto", "-f", "wav", ruta_original]
+            proceso = subprocess.run(comando, capture_output=True)
+            if proceso.returncode != 0:
+                raise RuntimeError(f"FFmpeg no pudo decodificar el audio: {proceso.stderr.decode(errors='ignore')}")
+            pcm_16k = np.frombuffer(proceso.stdout, dtype=np.float32)
+            pcm_original, sample_rate = None, None
+            if con_original:
+                pcm_original, sample_rate = sf.read(ruta_original, dtype='int16', always_2d=True)
+        return cls(ruta, pcm_16k, pcm_original, sample_rate)
+
+    def pcm_int16(self):
+        """Versión int16 del buffer de 16 kHz (para las utilidades de pydub)."""
+        return (np.clip(self.pcm_16k, -1.0, 1.0) * 32767).astype(np.int16)
+
+    def recortar(self, intervalos_ms):
+        """Devuelve un nuevo AudioDecodificado que solo contiene los intervalos (inicio, fin) en ms."""
+        return AudioDecodificado(
+            self.ruta,
+            DetectorSilencios.recortar_pcm(self.pcm_16k, self.SAMPLE_RATE_WHISPER, intervalos_ms),
+            DetectorSilencios.recortar_pcm(self.pcm_original, self.sample_rate, intervalos_ms)
+            if self.pcm_original is not None else None,
+            self.sample_rate
+        )
+
+class MapaTiempos:
+    """Tabla de correspondencia entre el audio sin silencios y la línea de tiempo original."""
+    def __init__(self, intervalos_ms):
+        self.intervalos_ms = [(int(inicio), int(fin)) for inicio, fin in intervalos_ms]
+        # Inicio de cada intervalo conservado en ambas líneas de tiempo (segundos)
+        self.inicios_recortado = []
+        self.inicios_original = []
+        acumulado_ms = 0
+        for inicio, fin in self.intervalos_ms:
+            self.inicios_recortado.append(acumulado_ms / 1000)
+            self.inicios_original.append(inicio / 1000)
+            acumulado_ms += fin - inicio
+
+    def a_original(self, segundos: float, es_fin: bool = False) -> float:
+        """Convierte un tiempo del audio recortado al archivo original.
+        
+        Un fin que cae justo en una unión se asigna al intervalo anterior, no al siguiente."""
+        if not self.inicios_recortado:
+            return segundos
+        buscar = bisect.bisect_left if es_fin else bisect.bisect_right
+        i = max(buscar(self.inicios_recortado, segundos) - 1, 0)
+        return self.inicios_original[i] + (segundos - self.inicios_recortado[i])
+
+    def remapear_transcripcion(self, transcripcion):
+        """Remapea en su sitio los start/end de segmentos y palabras de Whisper."""
+        for segment in transcripcion.get('segments', []):
+            segment['start'] = self.a_original(segment['start'])
+            segment['end'] = self.a_original(segment['end'], es_fin=True)
+            for word in segment.get('words', []):
+                word['start'] = self.a_original(word['start'])
+                word['end'] = self.a_original(word['end'], es_fin=True)
+        return transcripcion
+
+# ============================================================
+# Línea de tiempo compacta de palabras
+# ============================================================
+class LineaTiempoPalabras:
+    """Palabras de la transcripción en formato columnar: tiempos en arrays float32 y cada palabra
+    normalizada como id entero de un vocabulario compartido.
+    
+    Sustituye a las listas de dicts por palabra; al cortarla con [inicio:fin] se obtiene una vista
+    con índices locales que comparte arrays y vocabulario."""
+    __slots__ = ("textos", "ids", "vocabulario", "inicios", "fines")
+    DECIMALES = 3  # float32 solo garantiza ~1 ms en audios de horas; se redondea al leer
+
+    def __init__(self, textos, ids, vocabulario, inicios, fines):
+        self.textos = textos
+        self.ids = ids
+        self.vocabulario = vocabulario
+        self.inicios = inicios
+        self.fines = fines
+
+    @classmethod
+    def desde_transcripcion(cls, transcripcion, normalizar):
+        """Construye la línea de tiempo a partir del resultado de Whisper (omite palabras vacías)."""
+        textos, ids, inicios, fines = [], [], [], []
+        vocabulario, id_de = [], {}
+        for segment in transcripcion.get('segments', []):
+            for word in segment.get('words', []):
+                texto = word['word'].strip()
+                if not texto:
+                    continue
+                textos.append(sys.intern(texto))
+                token = normalizar(texto)
+                if token not in id_de:
+                    id_de[token] = len(vocabulario)
+                    vocabulario.append(token)
+                ids.append(id_de[token])
+                inicios.append(word['start'])
+                fines.append(word['end'])
+        return cls(textos, np.array(ids, dtype=np.int32), vocabulario,
+                   np.array(inicios, dtype=np.float32), np.array(fines, dtype=np.float32))
+
+    def __len__(self):
+        return len(self.textos)
+
+    def __getitem__(self, rango):
+        if not isinstance(rango, slice):
+            raise TypeError("LineaTiempoPalabras solo admite cortes [inicio:fin]")
+        return LineaTiempoPalabras(self.textos[rango], self.ids[rango], self.vocabulario,
+                                   self.inicios[rango], self.fines[rango])
+
+    def inicio(self, i):
+        return round(float(self.inicios[i]), self.DECIMALES)
+
+    def fin(self, i):
+        return round(float(self.fines[i]), self.DECIMALES)
+
+    def tiempos(self):
+        """Listas de inicios y fines en segundos (float de Python, redondeados)."""
+        return (np.round(self.inicios.astype(np.float64), self.DECIMALES).tolist(),
+                np.round(self.fines.astype(np.float64), self.DECIMALES).tolist())
+
+    def texto(self, inicio=0, fin=None):
+        """Texto de las palabras [inicio, fin) separado por espacios."""
+        return " ".join(self.textos[inicio:fin])
+
+    def textos_normalizados(self):
+        return [self.vocabulario[i] for i in self.ids.tolist()]
+
+    # --- Artefacto compacto en disco: columnas .npz + cabecera JSON pequeña ---
+    VERSION_ARTEFACTO = 1
+
+    @staticmethod
+    def _empaquetar_textos(textos):
+        """Lista de str -> (bytes UTF-8 concatenados, desplazamientos int64 de longitud n+1)."""
+        codificados = [t.encode('utf-8') for t in textos]
+        desplazamientos = np.zeros(len(codificados) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in codificados], out=desplazamientos[1:])
+        return np.frombuffer(b"".join(codificados), dtype=np.uint8), desplazamientos
+
+    def guardar_artefacto(self, ruta_base, transcripcion):
+        """Escribe <ruta_base>.npz (palabras y segmentos en columnas, sin comprimir) y <ruta_base>.json
+        (cabecera). El .npz se escribe de una vez y se puede abrir de forma perezosa con np.load."""
+        segmentos = transcripcion.get('segments', [])
+        textos, desplazamientos_textos = self._empaquetar_textos(self.textos)
+        vocabulario, desplazamientos_vocabulario = self._empaquetar_textos(self.vocabulario)
+        textos_segmentos, desplazamientos_segmentos = self._empaquetar_textos(
+            [segment.get('text', '').strip() for segment in segmentos])
+        np.savez(
+            f"{ruta_base}.npz",
+            palabras_inicio=self.inicios,
+            palabras_fin=self.fines,
+            palabras_id=self.ids,
+            palabras_texto=textos,
+            palabras_texto_desplazamientos=desplazamientos_textos,
+            vocabulario=vocabulario,
+            vocabulario_desplazamientos=desplazamientos_vocabulario,
+            segmentos_inicio=np.array([segment['start'] for segment in segmentos], dtype=np.float32),
+            segmentos_fin=np.array([segment['end'] for segment in segmentos], dtype=np.float32),
+            segmentos_texto=textos_segmentos,
+            segmentos_texto_desplazamientos=desplazamientos_segmentos
+        )
+        cabecera = {
+            "version": self.VERSION_ARTEFACTO,
+            "idioma": transcripcion.get('language'),
+            "num_palabras": len(self),
+            "num_segmentos": len(segmentos),
+            "tamano_vocabulario": len(self.vocabulario),
+            "columnas": f"{os.path.basename(ruta_base)}.npz"
+        }
+        with open(f"{ruta_base}.json", 'w', encoding='utf-8') as f:
+            json.dump(cabecera, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def cargar_artefacto(cls, ruta_base):
+        """Reabre un artefacto escrito con guardar_artefacto como ArtefactoTranscripcion (perezoso)."""
+        return ArtefactoTranscripcion(ruta_base)
+
+class TextosEmpaquetados:
+    """Secuencia de str sobre bytes UTF-8 concatenados y sus desplazamientos.
+    
+    Cada texto se decodifica solo al acceder a él; cortar con [inicio:fin] devuelve una vista."""
+    __slots__ = ("datos", "desplazamientos", "_inicio", "_fin")
+
+    def __init__(self, datos, desplazamientos, inicio=0, fin=None):
+        self.datos = datos
+        self.desplazamientos = desplazamientos
+        self._inicio = inicio
+        self._fin = len(desplazamientos) - 1 if fin is None else fin
+
+    def __len__(self):
+        return self._fin - self._inicio
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            inicio, fin, paso = indice.indices(len(self))
+            if paso != 1:
+                raise TypeError("TextosEmpaquetados solo admite cortes contiguos")
+            return TextosEmpaquetados(self.datos, self.desplazamientos,
+                                      self._inicio + inicio, self._inicio + max(inicio, fin))
+        if indice < 0:
+            indice += len(self)
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        a, b = self.desplazamientos[self._inicio + indice:self._inicio + indice + 2].tolist()
+        return self.datos[a:b].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        limites = self.desplazamientos[self._inicio:self._fin + 1].tolist()
+        if not limites:
+            return
+        buffer = self.datos[limites[0]:limites[-1]].tobytes()
+        base = limites[0]
+        for a, b in zip(limites[:-1], limites[1:]):
+            yield buffer[a - base:b - base].decode('utf-8')
+
+class ArtefactoTranscripcion:
+    """Artefacto de transcripción reabierto desde disco.
+    
+    Mantiene abierto el .npz y lee cada columna la primera vez que se pide; los textos se
+    decodifican palabra a palabra bajo demanda. Se usa como gestor de contexto o con close()."""
+
+    def __init__(self, ruta_base):
+        with open(f"{ruta_base}.json", 'r', encoding='utf-8') as f:
+            self.cabecera = json.load(f)
+        if self.cabecera.get("version") != LineaTiempoPalabras.VERSION_ARTEFACTO:
+            raise ValueError(f"Versión de artefacto no soportada: {self.cabecera.get('version')}")
+        self._npz = np.load(f"{ruta_base}.npz")
+        self._columnas = {}
+
+    def columna(self, nombre):
+        """Array de la columna indicada, leído del .npz solo en el primer acceso."""
+        if nombre not in self._columnas:
+            self._columnas[nombre] = self._npz[nombre]
+        return self._columnas[nombre]
+
+    def _textos(self, nombre):
+        return TextosEmpaquetados(self.columna(nombre), self.columna(f"{nombre}_desplazamientos"))
+
+    @property
+    def palabras(self):
+        """LineaTiempoPalabras sobre las columnas de palabras."""
+        return LineaTiempoPalabras(
+            self._textos("palabras_texto"),
+            self.columna("palabras_id"),
+            self._textos("vocabulario"),
+            self.columna("palabras_inicio"),
+            self.columna("palabras_fin")
+        )
+
+    @property
+    def segmentos_inicio(self):
+        return self.columna("segmentos_inicio")
+
+    @property
+    def segmentos_fin(self):
+        return self.columna("segmentos_fin")
+
+    @property
+    def segmentos_texto(self):
+        return self._textos("segmentos_texto")
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ============================================================
+# Detección de silencios vectorizada
+# ============================================================
+class DetectorSilencios:
+    """Equivalente NumPy de pydub.silence (seek_step=1) que trabaja sobre arrays PCM."""
+    # Milisegundos procesados por bloque para acotar la memoria temporal
+    MS_POR_BLOQUE = 60000
+
+    @staticmethod
+    def limites_ms(n_muestras, sample_rate):
+        """Índice de la primera muestra de cada milisegundo (n_ms + 1 límites, escala real de ms)."""
+        n_ms = n_muestras * 1000 // sample_rate
+        return (np.arange(n_ms + 1, dtype=np.int64) * sample_rate) // 1000
+
+    @staticmethod
+    def energia_por_ms(pcm, sample_rate):
+        """Suma de cuadrados de cada milisegundo (todas las muestras y canales)."""
+        limites = DetectorSilencios.limites_ms(len(pcm), sample_rate)
+        n_ms = len(limites) - 1
+        energia = np.empty(n_ms, dtype=np.float64)
+        for inicio in range(0, n_ms, DetectorSilencios.MS_POR_BLOQUE):
+            fin = min(inicio + DetectorSilencios.MS_POR_BLOQUE, n_ms)
+            desde, hasta = limites[inicio], limites[fin]
+            bloque = pcm[desde:hasta].reshape(hasta - desde, -1).astype(np.float32)
+            cuadrados = np.einsum('ij,ij->i', bloque, bloque, dtype=np.float64)
+            # Con 44.1 kHz cada ms tiene 44 o 45 muestras; reduceat respeta esos límites reales
+            energia[inicio:fin] = np.add.reduceat(cuadrados, limites[inicio:fin] - desde)
+        return energia
+
+    @staticmethod
+    def rangos_no_silenciosos(pcm, sample_rate, min_silence_len, silence_thresh, amplitud_maxima=1.0):
+        """Devuelve los rangos [inicio, fin] en ms con sonido, como pydub.silence.detect_nonsilent."""
+        energia = DetectorSilencios.energia_por_ms(pcm, sample_rate)
+        duracion_ms = len(energia)
+        if duracion_ms < min_silence_len:
+            return [[0, duracion_ms]]
+
+        # RMS de cada ventana de min_silence_len ms con desplazamiento de 1 ms (sumas acumuladas)
+        acumulada = np.concatenate(([0.0], np.cumsum(energia)))
+        energia_ventana = acumulada[min_silence_len:] - acumulada[:-min_silence_len]
+        canales = pcm.shape[1] if pcm.ndim > 1 else 1
+        limites = DetectorSilencios.limites_ms(len(pcm), sample_rate)
+        muestras_ventana = (limites[min_silence_len:] - limites[:-min_silence_len]) * canales
+        umbral = (10 ** (silence_thresh / 20.0)) * amplitud_maxima
+        inicios_silencio = np.flatnonzero(energia_ventana / muestras_ventana <= umbral * umbral)
+        if len(inicios_silencio) == 0:
+            return [[0, duracion_ms]]
+
+        # Ventanas silenciosas que se solapan forman un único rango de silencio
+        cortes = np.flatnonzero(np.diff(inicios_silencio) > min_silence_len)
+        silencio_inicio = inicios_silencio[np.concatenate(([0], cortes + 1))]
+        silencio_fin = inicios_silencio[np.concatenate((cortes, [len(inicios_silencio) - 1]))] + min_silence_len
+        if silencio_inicio[0] == 0 and silencio_fin[0] == duracion_ms:
+            return []
+
+        rangos = []
+        fin_anterior = 0
+        for inicio, fin in zip(silencio_inicio.tolist(), silencio_fin.tolist()):
+            rangos.append([fin_anterior, inicio])
+            fin_anterior = fin
+        if fin_anterior != duracion_ms:
+            rangos.append([fin_anterior, duracion_ms])
+        if rangos[0] == [0, 0]:
+            rangos.pop(0)
+        return rangos
+
+    @staticmethod
+    def puntos_de_corte(pcm, sample_rate, duracion_min, duracion_max, ventana_ms=200):
+        """Elige cortes (ms) en la pausa más silenciosa de cada tramo de duracion_min-duracion_max s."""
+        energia = DetectorSilencios.energia_por_ms(pcm, sample_rate)
+        if len(energia) <= duracion_max * 1000:
+            return []
+        # Energía suavizada con una media móvil de ventana_ms
+        acumulada = np.concatenate(([0.0], np.cumsum(energia)))
+        suavizada = acumulada[ventana_ms:] - acumulada[:-ventana_ms]
+        cortes = []
+        inicio = 0
+        while len(energia) - inicio > duracion_max * 1000:
+            desde = inicio + int(duracion_min * 1000)
+            hasta = min(inicio + int(duracion_max * 1000), len(suavizada))
+            corte = desde + int(np.argmin(suavizada[desde:hasta])) + ventana_ms // 2
+            cortes.append(corte)
+            inicio = corte
+        return cortes
+
+    @staticmethod
+    def recortar_pcm(pcm, sample_rate, intervalos_ms):
+        """Concatena los intervalos (inicio, fin) en ms con una única copia sobre un array preasignado."""
+        cortes = [(inicio * sample_rate // 1000, min(fin * sample_rate // 1000, len(pcm)))
+                  for inicio, fin in intervalos_ms]
+        total = sum(max(fin - inicio, 0) for inicio, fin in cortes)
+        salida = np.empty((total,) + pcm.shape[1:], dtype=pcm.dtype)
+        posicion = 0
+        for inicio, fin in cortes:
+            if fin > inicio:
+                salida[posicion:posicion + fin - inicio] = pcm[inicio:fin]
+                posicion += fin - inicio
+        return salida
+
+# ============================================================
+# Alineación global de texto con las palabras de Whisper
+# ============================================================
+class AlineadorGlobal:
+    """Alinea la secuencia de palabras de GPT con la de Whisper en una sola pasada de programación
+    dinámica monótona (tipo Needleman-Wunsch) que tolera inserciones y omisiones.
+    
+    Solo se evalúa una banda alrededor de la diagonal; las similitudes de la banda se calculan por
+    bloques con rapidfuzz.process.cdist y cada fila del DP se resuelve vectorizada con NumPy."""
+    PENALIZACION_HUECO = -0.5
+    SIMILITUD_NEUTRA = 60  # Similitud (0-100) a partir de la cual emparejar dos palabras suma
+    FILAS_POR_BLOQUE = 512
+    _NEG = -1e9
+
+    @staticmethod
+    def _desplazar(fila, desplazamiento):
+        """fila[k + desplazamiento], con -inf fuera de rango."""
+        ancho = len(fila)
+        resultado = np.full(ancho, AlineadorGlobal._NEG)
+        if desplazamiento >= 0:
+            if desplazamiento < ancho:
+                resultado[:ancho - desplazamiento] = fila[desplazamiento:]
+        elif -desplazamiento < ancho:
+            resultado[-desplazamiento:] = fila[:ancho + desplazamiento]
+        return resultado
+
+    @staticmethod
+    def alinear(palabras_gpt, palabras_whisper, banda=200, workers=1):
+        """Devuelve, para cada palabra de GPT, (índice de la palabra de Whisper o -1, similitud 0-100).
+        
+        Ambas listas deben estar ya normalizadas."""
+        m, n = len(palabras_gpt), len(palabras_whisper)
+        if m == 0 or n == 0:
+            return [(-1, 0)] * m
+        hueco = AlineadorGlobal.PENALIZACION_HUECO
+        # La banda debe cubrir al menos el avance medio por fila para que el camino sea continuo
+        ancho = min(max(2 * banda + 1, -(-n // m) + 2), n + 1)
+        k = np.arange(ancho)
+        # Inicio de la banda de cada fila (columnas = palabras de Whisper consumidas, 0..n)
+        inicios = np.clip(np.rint(np.arange(m + 1) * n / m).astype(np.int64) - banda, 0, n + 1 - ancho)
+
+        punteros = np.zeros((m + 1, ancho), dtype=np.int8)  # 1 diagonal, 2 arriba, 3 izquierda
+        punteros[0, 1:] = 3
+        anterior = hueco * (inicios[0] + k)
+
+        for bloque in range(1, m + 1, AlineadorGlobal.FILAS_POR_BLOQUE):
+            filas = range(bloque, min(m + 1, bloque + AlineadorGlobal.FILAS_POR_BLOQUE))
+            col_min = max(0, inicios[filas[0]] - 1)
+            col_max = min(n, inicios[filas[-1]] + ancho - 1)
+            similitudes = process.cdist(
+                palabras_gpt[filas[0] - 1:filas[-1]], palabras_whisper[col_min:col_max],
+                scorer=fuzz.ratio, dtype=np.uint8, workers=workers
+            )
+            for j in filas:
+                inicio = inicios[j]
+                columnas = inicio + k
+                # Similitud de la palabra j-1 de GPT con la palabra i-1 de Whisper para cada columna i
+                indices = np.clip(columnas - 1 - col_min, 0, similitudes.shape[1] - 1)
+                puntuacion = (similitudes[j - filas[0], indices].astype(np.float64)
+                              - AlineadorGlobal.SIMILITUD_NEUTRA) / (100 - AlineadorGlobal.SIMILITUD_NEUTRA)
+                desplazamiento = inicio - inicios[j - 1]
+                diagonal = AlineadorGlobal._desplazar(anterior, desplazamiento - 1) + puntuacion
+                diagonal[columnas == 0] = AlineadorGlobal._NEG
+                arriba = AlineadorGlobal._desplazar(anterior, desplazamiento) + hueco
+                base = np.maximum(diagonal, arriba)
+                # Movimientos a la izquierda: fila[i] = max_k<=i(base[k] + hueco * (i - k))
+                actual = hueco * k + np.maximum.accumulate(base - hueco * k)
+                # (con tolerancia: la suma acumulada introduce errores de redondeo)
+                punteros[j] = np.where(actual > base + 1e-9, 3, np.where(diagonal >= arriba, 1, 2))
+                anterior = actual
+
+        # Reconstruir el camino desde (m, n)
+        resultado = [(-1, 0)] * m
+        j, i = m, n
+        emparejadas = {}
+        while j > 0 or i > 0:
+            movimiento = punteros[j, i - inicios[j]] if j > 0 else 3
+            if movimiento == 1:
+                emparejadas[j - 1] = i - 1
+                j, i = j - 1, i - 1
+            elif movimiento == 2:
+                j -= 1
+            else:
+                i -= 1
+        for j, i in emparejadas.items():
+            resultado[j] = (i, fuzz.ratio(palabras_gpt[j], palabras_whisper[i]))
+        return resultado
+
+# ============================================================
+# Cachés en disco
+# ============================================================
+class CacheDisco:
+    """Caché JSON en disco direccionada por contenido, con expulsión LRU por tamaño y TTL opcional.
+    
+    La fecha de modificación de cada entrada se usa como marca de último acceso;
+    la de creación se guarda dentro de la propia entrada."""
+    def __init__(self, carpeta, tamano_maximo_mb, ttl_segundos=None):
+        self.carpeta = carpeta
+        self.tamano_maximo = int(tamano_maximo_mb * 1024 * 1024)
+        self.ttl_segundos = ttl_segundos
+        os.makedirs(self.carpeta, exist_ok=True)
+
+    @staticmethod
+    def calcular_clave(*partes) -> str:
+        """Hash de las partes (bytes, arrays NumPy o valores serializables a JSON)."""
+        h = hashlib.blake2b(digest_size=32)
+        for parte in partes:
+            if isinstance(parte, np.ndarray):
+                h.update(np.ascontiguousarray(parte).data)
+            elif isinstance(parte, (bytes, bytearray)):
+                h.update(parte)
+            else:
+                h.update(json.dumps(parte, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+            h.update(b'\x00')
+        return h.hexdigest()
+
+    def _ruta(self, clave):
+        return os.path.join(self.carpeta, f"{clave}.json")
+
+    def obtener(self, clave):
+        """Devuelve el valor guardado o None si no existe o ha caducado."""
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                entrada = json.load(f)
+            if not isinstance(entrada, dict) or "valor" not in entrada:
+                return None
+            if self.ttl_segundos is not None and time.time() - entrada.get("creado", 0) > self.ttl_segundos:
+                os.remove(ruta)
+                return None
+            os.utime(ruta)  # Marcar como usado recientemente
+            return entrada["valor"]
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def guardar(self, clave, valor):
+        """Guarda el valor de forma atómica y poda las entradas menos usadas si hace falta."""
+        ruta = self._ruta(clave)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({"creado": time.time(), "valor": valor}, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+        self._podar()
+
+    def _podar(self):
+        """Elimina las entradas con acceso más antiguo hasta quedar por debajo del tamaño máximo."""
+        entradas = []
+        for nombre in os.listdir(self.carpeta):
+            if not nombre.endswith(".json"):
+                continue
+            try:
+                estado = os.stat(os.path.join(self.carpeta, nombre))
+            except OSError:
+                continue
+            entradas.append((estado.st_mtime, estado.st_size, nombre))
+        total = sum(tamano for _, tamano, _ in entradas)
+        for _, tamano, nombre in sorted(entradas):
+            if total <= self.tamano_maximo:
+                break
+            try:
+                os.remove(os.path.join(self.carpeta, nombre))
+                total -= tamano
+            except OSError:
+                pass
+
+# ============================================================
+# Motores de transcripción
+# ============================================================
+class MotorTranscripcion(ABC):
+    """Interfaz común de los motores de transcripción.
+    
+    transcribir() devuelve siempre un dict con la forma del de openai-whisper
+    ('text', 'segments' y 'words' dentro de cada segmento)."""
+    nombre = ""
+
+    @abstractmethod
+    def transcribir(self, audio, opciones):
+        """Transcribe audio (ruta o array float32 a 16 kHz) con las opciones de whisper."""
+
+class CacheModelos:
+    """Copias de modelos de Whisper cuantizadas a int8 y serializadas en la caché de usuario."""
+
+    @staticmethod
+    def ruta_whisper_int8(nombre_modelo):
+        import torch
+        version_torch = torch.__version__.replace('+', '_')
+        return os.path.join(Util.carpeta_cache("modelos"), f"whisper-{nombre_modelo}-int8-torch{version_torch}.pt")
+
+    @staticmethod
+    def cargar_whisper_int8(nombre_modelo):
+        """Carga la copia int8 (con mmap si torch lo admite); si no existe o está dañada la genera una vez."""
+        import torch
+        ruta = CacheModelos.ruta_whisper_int8(nombre_modelo)
+        if os.path.exists(ruta):
+            try:
+                # torch.load solo acepta mmap desde la 2.1; sin él se lee el archivo completo
+                if "mmap" in inspect.signature(torch.load).parameters:
+                    modelo = torch.load(ruta, map_location="cpu", mmap=True, weights_only=False)
+                else:
+                    modelo = torch.load(ruta, map_location="cpu")
+                modelo.eval()
+                return modelo
+            except Exception as e:
+                logger.info(f"⚠️ Caché de modelo inválida, se regenera: {str(e)}")
+
+        modelo = whisper.load_model(nombre_modelo, device="cpu")
+        # whisper.model.Linear solo añade un cast de dtype (irrelevante en CPU/fp32);
+        # quantize_dynamic solo reconoce nn.Linear exacto
+        for modulo in modelo.modules():
+            if isinstance(modulo, torch.nn.Linear):
+                modulo.__class__ = torch.nn.Linear
+        modelo = torch.ao.quantization.quantize_dynamic(modelo, {torch.nn.Linear}, dtype=torch.qint8)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        torch.save(modelo, temporal)
+        os.replace(temporal, ruta)
+        return modelo
+
+class MotorWhisper(MotorTranscripcion):
+    """openai-whisper sobre PyTorch (motor por defecto)."""
+    nombre = "whisper"
+
+    def __init__(self, nombre_modelo="small", modelo=None, cuantizado=False):
+        self.nombre_modelo = nombre_modelo
+        self.cuantizado = cuantizado
+        self._modelo = modelo
+
+    @property
+    def modelo(self):
+        if self._modelo is None:
+            if self.cuantizado:
+                self._modelo = CacheModelos.cargar_whisper_int8(self.nombre_modelo)
+            else:
+                self._modelo = whisper.load_model(self.nombre_modelo)
+        return self._modelo
+
+    def transcribir(self, audio, opciones):
+        return self.modelo.transcribe(audio, **opciones)
+
+class MotorCTranslate2(MotorTranscripcion):
+    """faster-whisper (CTranslate2) con pesos int8 en CPU."""
+    nombre = "ctranslate2"
+
+    def __init__(self, nombre_modelo="small", cuantizado=True, hilos=0):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise ImportError("El motor 'ctranslate2' requiere el paquete faster-whisper (pip install faster-whisper)")
+        self.nombre_modelo = nombre_modelo
+        self.cuantizado = cuantizado
+        compute_type = "int8" if cuantizado else "float32"
+        self.modelo = WhisperModel(nombre_modelo, device="cpu", compute_type=compute_type, cpu_threads=hilos)
+
+    def transcribir(self, audio, opciones):
+        segmentos, info = self.modelo.transcribe(
+            audio,
+            language=opciones.get("language"),
+            word_timestamps=opciones.get("word_timestamps", False),
+            condition_on_previous_text=opciones.get("condition_on_previous_text", True),
+            temperature=opciones.get("temperature", 0)
+        )
+        # Convertir a la estructura de openai-whisper que consume el resto del pipeline
+        resultado_segmentos = [
+            {
+                "id": segmento.id,
+                "seek": segmento.seek,
+                "start": segmento.start,
+                "end": segmento.end,
+                "text": segmento.text,
+                "tokens": list(segmento.tokens),
+                "temperature": segmento.temperature,
+                "avg_logprob": segmento.avg_logprob,
+                "compression_ratio": segmento.compression_ratio,
+                "no_speech_prob": segmento.no_speech_prob,
+                "words": [
+                    {"word": w.word, "start": w.start, "end": w.end, "probability": w.probability}
+                    for w in (segmento.words or [])
+                ]
+            }
+            for segmento in segmentos
+        ]
+        return {
+            "text": "".join(segmento["text"] for segmento in resultado_segmentos),
+            "segments": resultado_segmentos,
+            "language": info.language
+        }
+
+MOTORES_TRANSCRIPCION = {
+    MotorWhisper.nombre: MotorWhisper,
+    MotorCTranslate2.nombre: MotorCTranslate2
+}
+
+def crear_motor_transcripcion(nombre_motor="whisper", nombre_modelo="small", **opciones):
+    """Crea el motor de transcripción indicado por configuración."""
+    if nombre_motor not in MOTORES_TRANSCRIPCION:
+        raise ValueError(f"Motor de transcripción desconocido: {nombre_motor}")
+    return MOTORES_TRANSCRIPCION[nombre_motor](nombre_modelo, **opciones)
+
+# ============================================================
+# Presupuesto de hilos de CPU
+# ============================================================
+class PresupuestoHilos:
+    """Reparte os.cpu_count() entre trabajos concurrentes, procesos de transcripción,
+    hilos intra-op de torch y el trabajo auxiliar (alineación, pool de hilos). Es único por proceso."""
+    # Más de ~4 hilos intra-op por modelo apenas acelera Whisper; mejor más workers
+    HILOS_POR_WORKER = 4
+    # Se reserva 1/DIVISOR_AUXILIAR de los núcleos (al menos uno) al trabajo auxiliar, que en modo lote
+    # se solapa con la transcripción
+    DIVISOR_AUXILIAR = 4
+    _actual = None
+    _ejecutor = None
+
+    def __init__(self, trabajos_concurrentes=1, workers_transcripcion=1, nucleos=None):
+        self.nucleos = nucleos or os.cpu_count() or 1
+        self.trabajos_concurrentes = max(1, int(trabajos_concurrentes))
+        self.nucleos_auxiliares = max(1, self.nucleos // self.DIVISOR_AUXILIAR)
+        nucleos_transcripcion = max(1, self.nucleos - self.nucleos_auxiliares)
+        nucleos_por_trabajo = max(1, nucleos_transcripcion // self.trabajos_concurrentes)
+        if workers_transcripcion == "auto":
+            workers_transcripcion = max(1, nucleos_por_trabajo // self.HILOS_POR_WORKER)
+        self.workers_transcripcion = max(1, int(workers_transcripcion))
+        self.hilos_torch = max(1, nucleos_por_trabajo // self.workers_transcripcion)
+        # La alineación (cdist) de cada trabajo usa solo su parte de los núcleos auxiliares
+        self.hilos_alineacion = max(1, self.nucleos_auxiliares // self.trabajos_concurrentes)
+        # Pool para E/S y JSON de todos los trabajos (mismo criterio que ThreadPoolExecutor por defecto)
+        self.hilos_pool = max(self.trabajos_concurrentes, min(32, self.nucleos + 4))
+
+    def __repr__(self):
+        return (f"PresupuestoHilos(nucleos={self.nucleos}, trabajos={self.trabajos_concurrentes}, "
+                f"workers={self.workers_transcripcion}, hilos_torch={self.hilos_torch}, "
+                f"hilos_alineacion={self.hilos_alineacion}, hilos_pool={self.hilos_pool})")
+
+    @classmethod
+    def obtener(cls, config):
+        """Devuelve el presupuesto compartido, recalculándolo si cambia la configuración."""
+        presupuesto = cls(config.trabajos_concurrentes, config.workers_transcripcion)
+        if cls._actual is None or repr(cls._actual) != repr(presupuesto):
+            cls._actual = presupuesto
+            if cls._ejecutor is not None:
+                cls._ejecutor.shutdown(wait=False)
+                cls._ejecutor = None
+        return cls._actual
+
+    def ejecutor(self):
+        """Pool de hilos auxiliar compartido por todas las instancias."""
+        if PresupuestoHilos._ejecutor is None:
+            PresupuestoHilos._ejecutor = ThreadPoolExecutor(max_workers=self.hilos_pool)
+        return PresupuestoHilos._ejecutor
+
+    def aplicar(self):
+        """Fija los hilos intra-op de torch del proceso actual."""
+        import torch
+        torch.set_num_threads(self.hilos_torch)
+
+# ============================================================
+# Transcripción en paralelo (un modelo residente por proceso)
+# ============================================================
+_motor_worker = None
+
+def _inicializar_worker_transcripcion(nombre_motor, nombre_modelo, opciones_motor, hilos_torch):
+    """Carga el modelo una sola vez en cada proceso del pool."""
+    global _motor_worker
+    import torch
+    torch.set_num_threads(hilos_torch)
+    _motor_worker = crear_motor_transcripcion(nombre_motor, nombre_modelo, **opciones_motor)
+
+def _transcribir_fragmento(pcm, opciones):
+    """Transcribe un fragmento de audio en el proceso worker."""
+    return _motor_worker.transcribir(pcm, opciones)
+
+class PoolTranscripcion:
+    """Pool de procesos compartido entre instancias para no recargar los modelos en cada trabajo."""
+    _pool = None
+    _clave = None
+
+    @classmethod
+    def obtener(cls, nombre_motor, nombre_modelo, workers, opciones_motor=None, hilos_torch=1):
+        opciones_motor = opciones_motor or {}
+        clave = (nombre_motor, nombre_modelo, workers, tuple(sorted(opciones_motor.items())), hilos_torch)
+        if cls._pool is None or cls._clave != clave:
+            if cls._pool is not None:
+                cls._pool.shutdown()
+            cls._pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_inicializar_worker_transcripcion,
+                initargs=(nombre_motor, nombre_modelo, opciones_motor, hilos_torch)
+            )
+            cls._clave = clave
+        return cls._pool
+
+# ============================================================
+# Planificador de peticiones a la API
+# ============================================================
+class ContadorTokens:
+    """Cuenta tokens con el tokenizador local de tiktoken (dependencia de openai-whisper).
+    
+    Si tiktoken o su vocabulario no están disponibles se recurre a la estimación de 4 caracteres por token."""
+    _codificadores = {}
+
+    @classmethod
+    def _codificador(cls, modelo):
+        if modelo not in cls._codificadores:
+            try:
+                import tiktoken
+                try:
+                    cls._codificadores[modelo] = tiktoken.encoding_for_model(modelo)
+                except KeyError:
+                    cls._codificadores[modelo] = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.info(f"ℹ️ Tokenizador no disponible ({e}); se estiman 4 caracteres por token")
+                cls._codificadores[modelo] = None
+        return cls._codificadores[modelo]
+
+    @classmethod
+    def contar(cls, texto, modelo="gpt-4-turbo-preview"):
+        codificador = cls._codificador(modelo)
+        if codificador is None:
+            return len(texto) // 4
+        return len(codificador.encode(texto, disallowed_special=()))
+
+class ParserJSONIncremental:
+    """Extrae los elementos de una lista JSON (p. ej. "analisis_segmentos") a medida que llega el texto.
+    
+    Recorre cada carácter una sola vez siguiendo la profundidad y las cadenas; cada elemento de la
+    lista de nivel superior con clave `clave` se decodifica en cuanto se cierra."""
+    def __init__(self, clave):
+        self.clave = clave
+        self.texto = ""
+        self._pos = 0
+        self._profundidad = 0
+        self._en_cadena = False
+        self._escape = False
+        self._inicio_cadena = None
+        self._fin_ultima_clave = None  # Posición tras la última clave de nivel superior que coincide
+        self._en_lista = False
+        self._inicio_elemento = None
+
+    def alimentar(self, fragmento):
+        """Añade texto y devuelve los elementos completados con él."""
+        self.texto += fragmento
+        texto = self.texto
+        elementos = []
+        while self._pos < len(texto):
+            c = texto[self._pos]
+            if self._en_cadena:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._en_cadena = False
+                    if self._profundidad == 1 and texto[self._inicio_cadena + 1:self._pos] == self.clave:
+                        self._fin_ultima_clave = self._pos + 1
+            elif c == '"':
+                self._en_cadena = True
+                self._inicio_cadena = self._pos
+            elif c in '{[':
+                if (c == '[' and self._profundidad == 1 and self._fin_ultima_clave is not None
+                        and texto[self._fin_ultima_clave:self._pos].strip() == ':'):
+                    self._en_lista = True
+                elif c == '{' and self._en_lista and self._profundidad == 2:
+                    self._inicio_elemento = self._pos
+                self._profundidad += 1
+            elif c in '}]':
+                self._profundidad -= 1
+                if self._en_lista and self._profundidad == 2 and self._inicio_elemento is not None:
+                    elementos.append(json.loads(texto[self._inicio_elemento:self._pos + 1]))
+                    self._inicio_elemento = None
+                elif self._en_lista and self._profundidad == 1:
+                    self._en_lista = False
+                    self._fin_ultima_clave = None
+            self._pos += 1
+        return elementos
+
+class CuboTokens:
+    """Token bucket que se rellena de forma continua hasta su capacidad por minuto."""
+    def __init__(self, capacidad_por_minuto):
+        self.capacidad = float(capacidad_por_minuto)
+        self.disponible = self.capacidad
+        self.ultima_recarga = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def adquirir(self, cantidad):
+        cantidad = min(float(cantidad), self.capacidad)
+        async with self._lock:
+            while True:
+                ahora = time.monotonic()
+                self.disponible = min(self.capacidad,
+                                      self.disponible + (ahora - self.ultima_recarga) * self.capacidad / 60)
+                self.ultima_recarga = ahora
+                if self.disponible >= cantidad:
+                    self.disponible -= cantidad
+                    return
+                await asyncio.sleep((cantidad - self.disponible) * 60 / self.capacidad)
+
+class PlanificadorPeticiones:
+    """Concurrencia máxima, límites de peticiones/tokens por minuto y reintentos con backoff
+    exponencial y jitter. Hay uno por bucle de eventos, compartido por todos los trabajos."""
+    ERRORES_REINTENTABLES = (RateLimitError, APITimeoutError, APIConnectionError,
+                             InternalServerError, asyncio.TimeoutError)
+    ESPERA_BASE = 1.0
+    ESPERA_MAXIMA = 60.0
+    _por_bucle = weakref.WeakKeyDictionary()
+
+    def __init__(self, max_en_vuelo, peticiones_por_minuto, tokens_por_minuto, max_reintentos):
+        self.semaforo = asyncio.Semaphore(max_en_vuelo)
+        self.limite_peticiones = CuboTokens(peticiones_por_minuto)
+        self.limite_tokens = CuboTokens(tokens_por_minuto)
+        self.max_reintentos = max_reintentos
+
+    @classmethod
+    def compartido(cls, config):
+        """Planificador del bucle actual (los primitivos de asyncio no se comparten entre bucles)."""
+        bucle = asyncio.get_running_loop()
+        if bucle not in cls._por_bucle:
+            cls._por_bucle[bucle] = cls(config.max_peticiones_en_vuelo, config.peticiones_por_minuto,
+                                        config.tokens_por_minuto, config.max_reintentos_gpt)
+        return cls._por_bucle[bucle]
+
+    def _espera(self, intento, error):
+        """Backoff exponencial con jitter; respeta Retry-After si la API lo indica."""
+        respuesta = getattr(error, "response", None)
+        retry_after = respuesta.headers.get("retry-after") if respuesta is not None else None
+        try:
+            return min(float(retry_after), self.ESPERA_MAXIMA)
+        except (TypeError, ValueError):
+            return min(self.ESPERA_MAXIMA, self.ESPERA_BASE * 2 ** intento) * random.uniform(0.5, 1.0)
+
+    async def ejecutar(self, crear_peticion, tokens_estimados):
+        """Ejecuta crear_peticion() (que devuelve una corrutina) respetando límites y reintentos."""
+        for intento in range(self.max_reintentos + 1):
+            await self.limite_peticiones.adquirir(1)
+            await self.limite_tokens.adquirir(tokens_estimados)
+            async with self.semaforo:
+                try:
+                    return await crear_peticion()
+                except self.ERRORES_REINTENTABLES as e:
+                    if intento == self.max_reintentos:
+                        raise
+                    espera = self._espera(intento, e)
+                    logger.info(f"⏳ {type(e).__name__}: reintento {intento + 1} en {espera:.1f}s")
+            await asyncio.sleep(espera)
+
 # ============================================================
 # Clase principal de procesamiento
 # ============================================================
 class MoodboardSimple:
     # Compilamos la expresión regular una única vez para normalizar texto
     _patron_normalizar = re.compile(r'[^\w\s]')
+    EXTENSIONES_AUDIO = (".mp3", ".wav", ".m4a")
 
-    def __init__(self, audio_folder=None, whisper_model=None):
+    def __init__(self, audio_folder=None, whisper_model=None, config=None):
+        self.config = config if config else ConfiguracionPipeline()
+        
         # Usar la carpeta proporcionada o la carpeta Documentos del usuario como respaldo
         self.CARPETA_AUDIOS = audio_folder if audio_folder else os.path.expanduser("~/Documents/Sound to XML Output")
         
@@ -119,14 +1236,23 @@ class MoodboardSimple:
         self.ensure_folders_exist()
         self.proyecto = ProyectoEdicion()
         self.segmentos_procesados = []
-        self.model = whisper_model if whisper_model else whisper.load_model("small")
+        # Tokens del prompt de cada grupo del análisis visual (medición de la ventana de contexto)
+        self.tokens_prompt_grupos = {}
+        # Progreso del análisis visual: índices ya recibidos y callback opcional
+        # al_marcador_parcial(indice, segmento, analisis) para mostrar marcadores parciales
+        self.segmentos_analizados = set()
+        self.al_marcador_parcial = None
+        # whisper_model puede ser un MotorTranscripcion o un modelo de openai-whisper ya cargado
+        if whisper_model is None or isinstance(whisper_model, MotorTranscripcion):
+            self._motor = whisper_model
+        else:
+            self._motor = MotorWhisper(self.config.modelo_whisper, modelo=whisper_model)
         
-        # Actualizar la inicialización del cliente OpenAI
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+        # Cliente OpenAI asíncrono: todas las llamadas pasan por _llamada_gpt
+        # (los reintentos los gestiona PlanificadorPeticiones)
         self.async_client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY")
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=0
         )
         
         # Configurar FFmpeg - Usar los binarios del sistema directamente
@@ -137,6 +1263,41 @@ class MoodboardSimple:
         if not all([AudioSegment.converter, AudioSegment.ffmpeg, AudioSegment.ffprobe]):
             raise FileNotFoundError("FFmpeg y FFprobe deben estar instalados en el sistema. Instálalos con 'brew install ffmpeg'")
     
+    @property
+    def motor(self):
+        """Motor de transcripción del proceso principal, creado solo cuando se necesita."""
+        if self._motor is None:
+            self._motor = crear_motor_transcripcion(
+                self.config.motor_transcripcion, self.config.modelo_whisper, **self._opciones_motor()
+            )
+        return self._motor
+    
+    def _opciones_motor(self):
+        """Opciones de construcción del motor derivadas de la configuración."""
+        opciones = {}
+        if self.config.modelo_cuantizado is not None:
+            opciones["cuantizado"] = self.config.modelo_cuantizado
+        if self.config.motor_transcripcion == MotorCTranslate2.nombre:
+            opciones["hilos"] = self.presupuesto.hilos_torch
+        return opciones
+    
+    def _descripcion_motor(self):
+        """Motor, modelo y cuantización que transcribirán, sin crear el motor.
+        
+        Un motor inyectado (p. ej. desde la GUI) solo se usa en el proceso principal; con varios
+        workers el pool crea sus motores a partir de la configuración."""
+        if self._motor is not None and self.presupuesto.workers_transcripcion <= 1:
+            return [self._motor.nombre, getattr(self._motor, "nombre_modelo", None),
+                    getattr(self._motor, "cuantizado", None)]
+        # Los hilos no cambian el resultado y no deben invalidar la caché
+        opciones = {k: v for k, v in self._opciones_motor().items() if k != "hilos"}
+        return [self.config.motor_transcripcion, self.config.modelo_whisper, opciones]
+    
+    @property
+    def presupuesto(self):
+        """Presupuesto de hilos compartido por todas las instancias del proceso."""
+        return PresupuestoHilos.obtener(self.config)
+    
     def _create_project_folder(self):
         """Genera un nombre único para la carpeta del proyecto basado en la fecha."""
         fecha = datetime.now().strftime("%Y-%m-%d")
@@ -181,13 +1342,32 @@ class MoodboardSimple:
     def obtener_archivo_audio(self):
         """Busca en la carpeta un archivo de audio con extensiones válidas."""
         archivos = [f for f in os.listdir(self.CARPETA_AUDIOS)
-                    if f.lower().endswith((".mp3", ".wav", ".m4a"))]
+                    if f.lower().endswith(self.EXTENSIONES_AUDIO)]
         if not archivos:
             raise FileNotFoundError("❌ No se encontraron archivos de audio.")
         return os.path.join(self.CARPETA_AUDIOS, archivos[0])
     
-    def transcribir_audio(self, audio_path):
-        """Transcribe el audio usando Whisper y guarda la transcripción con timestamps."""
+    @staticmethod
+    def listar_archivos_audio(entradas):
+        """Expande carpetas y patrones glob en una lista ordenada de archivos de audio sin duplicados."""
+        archivos = []
+        for entrada in entradas:
+            if os.path.isdir(entrada):
+                candidatos = sorted(os.path.join(entrada, f) for f in os.listdir(entrada))
+            else:
+                candidatos = sorted(glob.glob(entrada))
+            archivos.extend(os.path.abspath(f) for f in candidatos
+                            if os.path.isfile(f) and f.lower().endswith(MoodboardSimple.EXTENSIONES_AUDIO))
+        archivos = list(dict.fromkeys(archivos))
+        if not archivos:
+            raise FileNotFoundError("❌ No se encontraron archivos de audio.")
+        return archivos
+    
+    def transcribir_audio(self, audio_path, mapa_tiempos=None):
+        """Transcribe el audio usando Whisper y guarda la transcripción con timestamps.
+        
+        audio_path puede ser una ruta o un array float32 mono a 16 kHz ya decodificado.
+        Si se indica mapa_tiempos, los tiempos se llevan a la línea de tiempo original."""
         self.print_status("Transcribiendo audio con timestamps de palabras...", "🎙")
         try:
             # Configurar FFmpeg y ambiente
@@ -200,44 +1380,140 @@ class MoodboardSimple:
             os.environ["AUDIODEV"] = "null"
             os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
             
-            # Cargar el audio sin reproducirlo
-            import torch
-            torch.set_num_threads(1)
+            # Hilos intra-op según el presupuesto compartido
+            self.presupuesto.aplicar()
             
-            # Configurar Whisper con solo los parámetros soportados
-            self.transcripcion = self.model.transcribe(
-                audio_path,
-                word_timestamps=True,
-                condition_on_previous_text=False,
-                verbose=False,
-                temperature=0,
-                language='es',
-                fp16=False
-            )
+            self.transcripcion, cache, clave = None, None, None
+            if self.config.cache_transcripciones:
+                if isinstance(audio_path, str):
+                    # Decodificar aquí (como haría Whisper) para poder hashear el audio
+                    audio_path = whisper.load_audio(audio_path)
+                cache = CacheDisco(Util.carpeta_cache("transcripciones"),
+                                   self.config.tamano_cache_transcripciones_mb)
+                clave = CacheDisco.calcular_clave(
+                    audio_path, self._descripcion_motor(), self._opciones_whisper(),
+                    [self.config.min_silence_len, self.config.silence_thresh, self.config.keep_silence]
+                )
+                self.transcripcion = cache.obtener(clave)
+                if self.transcripcion is not None:
+                    self.print_status("Transcripción recuperada de la caché", "♻️")
+            
+            if self.transcripcion is None:
+                if self.presupuesto.workers_transcripcion > 1:
+                    self.transcripcion = self._transcribir_paralelo(audio_path)
+                else:
+                    self.transcripcion = self.motor.transcribir(audio_path, self._opciones_whisper())
+                if cache is not None:
+                    cache.guardar(clave, self.transcripcion)
+            if mapa_tiempos is not None:
+                mapa_tiempos.remapear_transcripcion(self.transcripcion)
+            
+            # A partir de aquí todo se lee de la línea de tiempo compacta
+            self.palabras = LineaTiempoPalabras.desde_transcripcion(self.transcripcion, self.normalizar_texto)
             
             # Guardar la transcripción
-            with open(self.analysis_path, 'w', encoding='utf-8') as f:
-                json.dump(self.transcripcion, f, ensure_ascii=False, indent=2)
+            if self.config.formato_transcripcion == "npz":
+                self.palabras.guardar_artefacto(os.path.splitext(self.analysis_path)[0], self.transcripcion)
+            else:
+                with open(self.analysis_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.transcripcion, f, ensure_ascii=False, indent=2)
+            
+            # Liberar la estructura anidada de Whisper
+            self.transcripcion = None
             
             self.generar_srt_palabras()
         except Exception as e:
             raise Exception(f"Error en la transcripción: {str(e)}")
     
+    def _opciones_whisper(self):
+        """Parámetros de Whisper (solo los soportados) comunes a todos los modos de transcripción."""
+        return {
+            "word_timestamps": True,
+            "condition_on_previous_text": False,
+            "verbose": False,
+            "temperature": 0,
+            "language": 'es',
+            "fp16": False
+        }
+    
+    def _transcribir_paralelo(self, audio):
+        """Trocea el audio en pausas, transcribe los fragmentos en paralelo y une el resultado."""
+        if isinstance(audio, str):
+            audio = whisper.load_audio(audio)
+        sample_rate = AudioDecodificado.SAMPLE_RATE_WHISPER
+        total_ms = len(audio) * 1000 // sample_rate
+        cortes = DetectorSilencios.puntos_de_corte(
+            audio, sample_rate,
+            self.config.duracion_min_fragmento, self.config.duracion_max_fragmento
+        )
+        limites = [0] + cortes + [total_ms]
+        solape_ms = int(self.config.solape_fragmento * 1000)
+        self.print_status(
+            f"Transcribiendo {len(limites) - 1} fragmentos con {self.presupuesto.workers_transcripcion} procesos...", "🚀"
+        )
+
+        pool = PoolTranscripcion.obtener(
+            self.config.motor_transcripcion, self.config.modelo_whisper, self.presupuesto.workers_transcripcion,
+            self._opciones_motor(), self.presupuesto.hilos_torch
+        )
+        opciones = self._opciones_whisper()
+        futuros = []
+        for inicio_ms, fin_ms in zip(limites, limites[1:]):
+            desde_ms = max(inicio_ms - solape_ms, 0)
+            hasta_ms = min(fin_ms + solape_ms, total_ms)
+            fragmento = audio[desde_ms * sample_rate // 1000:hasta_ms * sample_rate // 1000]
+            futuros.append((desde_ms / 1000, inicio_ms / 1000, fin_ms / 1000,
+                            pool.submit(_transcribir_fragmento, fragmento, opciones)))
+
+        segmentos = []
+        for desplazamiento, inicio, fin, futuro in futuros:
+            segmentos.extend(self._unir_fragmento(futuro.result(), desplazamiento, inicio, fin))
+        for i, segment in enumerate(segmentos):
+            segment['id'] = i
+        return {
+            "text": "".join(segment.get('text', '') for segment in segmentos),
+            "segments": segmentos,
+            "language": opciones["language"]
+        }
+    
+    @staticmethod
+    def _unir_fragmento(resultado, desplazamiento, inicio, fin):
+        """Corrige los tiempos de un fragmento y descarta lo que pertenece al solape de sus vecinos.
+        
+        Cada palabra se asigna al fragmento en cuyo tramo [inicio, fin) empieza, así que las
+        palabras repetidas en el solape se conservan exactamente una vez."""
+        segmentos = []
+        for segment in resultado.get('segments', []):
+            segment['start'] += desplazamiento
+            segment['end'] += desplazamiento
+            palabras = segment.get('words', [])
+            for word in palabras:
+                word['start'] += desplazamiento
+                word['end'] += desplazamiento
+            conservadas = [w for w in palabras if inicio <= w['start'] < fin]
+            if palabras:
+                if not conservadas:
+                    continue
+                if len(conservadas) != len(palabras):
+                    segment['words'] = conservadas
+                    segment['text'] = "".join(w['word'] for w in conservadas)
+                    segment['start'] = conservadas[0]['start']
+                    segment['end'] = conservadas[-1]['end']
+            elif not inicio <= segment['start'] < fin:
+                continue
+            segmentos.append(segment)
+        return segmentos
+    
     def generar_srt_palabras(self):
         """Genera un SRT que detalla el tiempo exacto de cada palabra."""
         self.print_status("Generando SRT con tiempos por palabra...", "📝")
+        inicios, fines = self.palabras.tiempos()
         with open(self.words_srt_path, 'w', encoding='utf-8') as f:
-            word_count = 1
-            for segment in self.transcripcion.get('segments', []):
-                for word in segment.get('words', []):
-                    f.write(f"{word_count}\n")
-                    tiempo_inicio = Util.segundos_a_srt(word['start'])
-                    tiempo_fin = Util.segundos_a_srt(word['end'])
-                    f.write(f"{tiempo_inicio} --> {tiempo_fin}\n")
-                    duracion = word['end'] - word['start']
-                    f.write(f"{word['word']}\n")
-                    f.write(f"[Duración: {duracion:.3f}s]\n\n")
-                    word_count += 1
+            for i, (texto, inicio, fin) in enumerate(zip(self.palabras.textos, inicios, fines), 1):
+                f.write(f"{i}\n")
+                f.write(f"{Util.segundos_a_srt(inicio)} --> {Util.segundos_a_srt(fin)}\n")
+                f.write(f"{texto}\n")
+                f.write(f"[Duración: {fin - inicio:.3f}s]\n\n")
         self.print_status(f"SRT de palabras generado: {self.words_srt_path}", "✅")
     
     def copiar_audio(self, audio_path):
@@ -258,14 +1534,14 @@ class MoodboardSimple:
             AudioSegment.ffprobe = shutil.which('ffprobe')
             
             audio = AudioSegment.from_file(audio_path)
-            min_silence_len = 500  # ms
-            silence_thresh = -40   # dB
-            keep_silence = 100     # ms a mantener
-            chunks = split_on_silence(audio, 
-                                    min_silence_len=min_silence_len,
-                                    silence_thresh=silence_thresh,
-                                    keep_silence=keep_silence)
-            audio_sin_silencios = sum(chunks)
+            if self.config.motor_silencios == "numpy":
+                audio_sin_silencios = self._eliminar_silencios_numpy(audio)
+            else:
+                chunks = split_on_silence(audio, 
+                                        min_silence_len=self.config.min_silence_len,
+                                        silence_thresh=self.config.silence_thresh,
+                                        keep_silence=self.config.keep_silence)
+                audio_sin_silencios = sum(chunks)
             nombre_base, extension = os.path.splitext(audio_path)
             audio_procesado = f"{nombre_base}_sin_silencios{extension}"
             
@@ -281,9 +1557,156 @@ class MoodboardSimple:
         except Exception as e:
             raise Exception(f"Error al eliminar silencios: {str(e)}")
     
+    def _eliminar_silencios_numpy(self, audio):
+        """Recorta un AudioSegment con el detector vectorizado y una sola copia de salida."""
+        pcm = np.array(audio.get_array_of_samples()).reshape(-1, audio.channels)
+        rangos = DetectorSilencios.rangos_no_silenciosos(
+            pcm, audio.frame_rate,
+            self.config.min_silence_len, self.config.silence_thresh,
+            amplitud_maxima=audio.max_possible_amplitude
+        )
+        intervalos = self._intervalos_conservados(rangos, len(audio))
+        pcm_recortado = DetectorSilencios.recortar_pcm(pcm, audio.frame_rate, intervalos)
+        return audio._spawn(pcm_recortado.tobytes())
+    
+    def _intervalos_conservados(self, rangos_no_silencio, duracion_ms):
+        """Aplica keep_silence a los rangos no silenciosos igual que split_on_silence."""
+        keep_silence = self.config.keep_silence
+        if isinstance(keep_silence, bool):
+            keep_silence = duracion_ms if keep_silence else 0
+        intervalos = [[inicio - keep_silence, fin + keep_silence] for inicio, fin in rangos_no_silencio]
+        # Si dos márgenes se solapan, se reparten el silencio por la mitad
+        for actual, siguiente in zip(intervalos, intervalos[1:]):
+            if siguiente[0] < actual[1]:
+                actual[1] = (actual[1] + siguiente[0]) // 2
+                siguiente[0] = actual[1]
+        return [(max(inicio, 0), min(fin, duracion_ms)) for inicio, fin in intervalos]
+    
+    def eliminar_silencios_pcm(self, audio, solo_mapa=False):
+        """Elimina silencios de un AudioDecodificado sin volver a decodificar ni exportar.
+        
+        Con solo_mapa=True no recorta nada y devuelve el MapaTiempos de los intervalos con voz."""
+        self.print_status("Eliminando silencios del audio en memoria...", "🔇")
+        try:
+            duracion_ms = int(audio.duracion * 1000)
+            if self.config.motor_silencios == "numpy":
+                rangos = DetectorSilencios.rangos_no_silenciosos(
+                    audio.pcm_16k, AudioDecodificado.SAMPLE_RATE_WHISPER,
+                    self.config.min_silence_len, self.config.silence_thresh
+                )
+            else:
+                segmento_16k = AudioSegment(
+                    data=audio.pcm_int16().tobytes(),
+                    sample_width=2,
+                    frame_rate=AudioDecodificado.SAMPLE_RATE_WHISPER,
+                    channels=1
+                )
+                rangos = detect_nonsilent(segmento_16k,
+                                          min_silence_len=self.config.min_silence_len,
+                                          silence_thresh=self.config.silence_thresh)
+            intervalos = self._intervalos_conservados(rangos, duracion_ms)
+            if solo_mapa:
+                return MapaTiempos(intervalos)
+            audio_sin_silencios = audio.recortar(intervalos)
+            self.print_status(
+                f"Silencios eliminados: {audio.duracion:.1f}s -> {audio_sin_silencios.duracion:.1f}s", "✅"
+            )
+            return audio_sin_silencios
+        except Exception as e:
+            raise Exception(f"Error al eliminar silencios: {str(e)}")
+    
+    def preparar_audio_ffmpeg(self, audio_path):
+        """Elimina silencios, genera el asset y el PCM para Whisper en una única pasada de FFmpeg.
+        
+        El asset se escribe directamente en disco y solo el audio de 16 kHz mono llega a Python
+        por una tubería, así que la memoria no depende del formato ni la resolución del original."""
+        self.print_status("Preparando audio con FFmpeg (una sola pasada)...", "🔇")
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            raise FileNotFoundError("FFmpeg debe estar instalado en el sistema.")
+        nombre_base = os.path.splitext(os.path.basename(audio_path))[0]
+        destino = os.path.join(self.assets_path, f"{nombre_base}_sin_silencios.wav")
+        umbral = f"{self.config.silence_thresh}dB"
+        min_silencio = self.config.min_silence_len / 1000
+        margen = self.config.keep_silence / 1000
+        filtro = (
+            f"[0:a:0]silenceremove="
+            f"start_periods=1:start_duration=0:start_threshold={umbral}:start_silence={margen}:"
+            f"stop_periods=-1:stop_duration={min_silencio}:stop_threshold={umbral}:stop_silence={margen}:"
+            f"detection=rms,asplit=2[asset][stt];"
+            f"[stt]aresample={AudioDecodificado.SAMPLE_RATE_WHISPER},"
+            f"aformat=sample_fmts=flt:channel_layouts=mono[whisper]"
+        )
+        comando = [
+            ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", audio_path,
+            "-filter_complex", filtro,
+            "-map", "[asset]", "-c:a", "pcm_s16le", "-rf64", "auto", destino,
+            "-map", "[whisper]", "-f", "f32le", "pipe:1"
+        ]
+        try:
+            with tempfile.TemporaryFile() as errores:
+                proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, stderr=errores)
+                buffer = bytearray()
+                while True:
+                    bloque = proceso.stdout.read(1 << 20)
+                    if not bloque:
+                        break
+                    buffer += bloque
+                proceso.stdout.close()
+                if proceso.wait() != 0:
+                    errores.seek(0)
+                    raise RuntimeError(errores.read().decode(errors='ignore'))
+            # bytearray -> array escribible sin copia adicional
+            pcm_16k = np.frombuffer(buffer, dtype=np.float32)
+            self.print_status(f"Audio preparado: {len(pcm_16k) / AudioDecodificado.SAMPLE_RATE_WHISPER:.1f}s útiles", "✅")
+            return pcm_16k, destino
+        except Exception as e:
+            raise Exception(f"Error al preparar el audio con FFmpeg: {str(e)}")
+    
+    def exportar_asset(self, audio):
+        """Escribe la versión a frecuencia original en assets como WAV, sin recodificar con pérdidas."""
+        self.print_status("Guardando audio en assets...", "📁")
+        nombre_base = os.path.splitext(os.path.basename(audio.ruta))[0]
+        destino = os.path.join(self.assets_path, f"{nombre_base}_sin_silencios.wav")
+        sf.write(destino, audio.pcm_original, audio.sample_rate, subtype='PCM_16')
+        return destino
+    
     def _contar_tokens(self, texto: str) -> int:
-        """Estimación aproximada de tokens (4 caracteres = 1 token)."""
-        return len(texto) // 4
+        """Número de tokens según el tokenizador local (o estimación si no está disponible)."""
+        return ContadorTokens.contar(texto)
+
+    @staticmethod
+    def _empaquetar_grupos(costes, presupuesto):
+        """Divide segmentos consecutivos en grupos de coste (tokens) equilibrado.
+        
+        Usa el mínimo número de grupos en que ningún grupo supera el presupuesto (salvo un segmento
+        que por sí solo lo supere) y, con ese número, minimiza el coste del grupo más caro, para que
+        ninguno domine la latencia del gather. Devuelve una lista de (inicio, fin)."""
+        if not costes:
+            return []
+
+        def cortes_voraces(limite):
+            # Grupos lo más largos posible sin pasar de limite
+            cortes, coste_grupo = [0], 0
+            for i, coste in enumerate(costes):
+                if coste_grupo and coste_grupo + coste > limite:
+                    cortes.append(i)
+                    coste_grupo = 0
+                coste_grupo += coste
+            cortes.append(len(costes))
+            return cortes
+
+        num_grupos = len(cortes_voraces(max(presupuesto, max(costes)))) - 1
+        # Búsqueda binaria del menor coste máximo que cabe en num_grupos grupos
+        bajo, alto = max(costes), sum(costes)
+        while bajo < alto:
+            medio = (bajo + alto) // 2
+            if len(cortes_voraces(medio)) - 1 <= num_grupos:
+                alto = medio
+            else:
+                bajo = medio + 1
+        cortes = cortes_voraces(bajo)
+        return list(zip(cortes[:-1], cortes[1:]))
 
     def _registrar_uso_tokens(self, f, messages, response):
         """Registra el uso de tokens para una llamada a GPT."""
@@ -326,15 +1749,95 @@ class MoodboardSimple:
         f.write(f"\n{'='*100}\n")
         return tokens_total
 
-    async def _procesar_grupo_async(self, grupo, grupo_num, total_grupos, json_template, contexto_completo):
-        """Procesa un grupo de segmentos de manera asíncrona, utilizando el análisis previo del guion."""
-        # Preparar el texto del grupo actual
-        segmentos_grupo = "\n".join(
-            [f"[GRUPO ACTUAL] Segmento {i+1}: \"{s['texto']}\" ({s['tiempo_inicio']:.2f}s -> {s['tiempo_fin']:.2f}s)"
-             for i, s in enumerate(grupo, start=grupo_num * len(grupo))]
-        )
+    async def _llamada_gpt(self, messages, temperature, modelo="gpt-4-turbo-preview",
+                           al_recibir_elemento=None, clave_lista="analisis_segmentos"):
+        """Única vía de llamada a GPT: cliente asíncrono y timeout por llamada, sin bloquear el bucle.
+        
+        Pasa por el planificador compartido (concurrencia, límites por minuto y reintentos)
+        y, si está activada, por la caché de respuestas en disco.
+        
+        Con al_recibir_elemento y config.streaming_gpt la respuesta se recibe en streaming y se llama
+        a al_recibir_elemento(indice, elemento) en cuanto se cierra cada elemento de clave_lista.
+        Tras un reintento los índices se repiten desde 0, así que el receptor debe sobrescribir."""
+        cache, clave = None, None
+        if self.config.cache_gpt:
+            cache = CacheDisco(Util.carpeta_cache("gpt"), self.config.tamano_cache_gpt_mb,
+                               ttl_segundos=self.config.ttl_cache_gpt_horas * 3600)
+            clave = CacheDisco.calcular_clave(modelo, temperature, "json_object", messages)
+            if not self.config.refrescar_cache_gpt:
+                respuesta = cache.obtener(clave)
+                if respuesta is not None:
+                    self.print_status("Respuesta de GPT recuperada de la caché", "♻️")
+                    if al_recibir_elemento is not None:
+                        elementos = ParserJSONIncremental(clave_lista).alimentar(respuesta)
+                        for indice, elemento in enumerate(elementos):
+                            al_recibir_elemento(indice, elemento)
+                    return respuesta
+
+        motivo_fin_stream = None
+
+        async def consumir_stream():
+            nonlocal motivo_fin_stream
+            motivo_fin_stream = None
+            parser = ParserJSONIncremental(clave_lista)
+            stream = await self.async_client.chat.completions.create(
+                model=modelo,
+                messages=messages,
+                temperature=temperature,
+                response_format={"type": "json_object"},
+                stream=True,
+                timeout=self.config.timeout_gpt
+            )
+            indice = 0
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    motivo_fin_stream = chunk.choices[0].finish_reason
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                for elemento in parser.alimentar(chunk.choices[0].delta.content):
+                    al_recibir_elemento(indice, elemento)
+                    indice += 1
+            return parser.texto
+
+        def crear_peticion():
+            if al_recibir_elemento is not None and self.config.streaming_gpt:
+                return asyncio.wait_for(consumir_stream(), timeout=self.config.timeout_gpt)
+            return asyncio.wait_for(
+                self.async_client.chat.completions.create(
+                    model=modelo,
+                    messages=messages,
+                    temperature=temperature,
+                    response_format={"type": "json_object"},
+                    timeout=self.config.timeout_gpt
+                ),
+                timeout=self.config.timeout_gpt
+            )
+        # Tokens del prompt más un margen para la respuesta
+        tokens_estimados = sum(self._contar_tokens(m["content"]) for m in messages) + 1000
+        response = await PlanificadorPeticiones.compartido(self.config).ejecutar(crear_peticion, tokens_estimados)
+        if isinstance(response, str):
+            respuesta, motivo_fin = response, motivo_fin_stream
+        else:
+            respuesta = response.choices[0].message.content
+            motivo_fin = response.choices[0].finish_reason
+            if al_recibir_elemento is not None:
+                for indice, elemento in enumerate(json.loads(respuesta).get(clave_lista, [])):
+                    al_recibir_elemento(indice, elemento)
+        # Solo se cachean respuestas completas y con JSON válido; una truncada se repetiría en cada ejecución
+        if cache is not None and motivo_fin == "stop" and self._es_json_valido(respuesta):
+            cache.guardar(clave, respuesta)
+        return respuesta
+
+    @staticmethod
+    def _es_json_valido(texto):
+        try:
+            json.loads(texto)
+            return True
+        except (TypeError, ValueError):
+            return False
 
-        # Obtener el análisis previo del guion
+    def _resumen_global_guion(self):
+        """Resumen compacto del análisis previo del guion, calculado una vez y compartido por todos los grupos."""
         analisis_previo = self.proyecto.metadata["analisis_guion"]
         
         # Preparar información del estilo visual
@@ -366,11 +1869,11 @@ Paleta de colores: {', '.join(estilo_visual.get('paleta_colores', ['No especific
             for ref in analisis_previo.get("referencias_visuales", [])
         ])
 
-        prompt_analisis = f'''Analiza cada segmento y genera un plan visual detallado, considerando el análisis previo del guion y el contexto completo.
-
-ANÁLISIS PREVIO DEL GUION:
+        elementos_tecnicos = analisis_previo.get('elementos_tecnicos', {})
+        return f"""ANÁLISIS PREVIO DEL GUION:
 Tema principal: {analisis_previo.get('tema_principal', 'No especificado')}
 Tono: {analisis_previo.get('tono', 'No especificado')}
+Estructura: {analisis_previo.get('estructura', 'No especificada')}
 Mensaje clave: {analisis_previo.get('mensaje_clave', 'No especificado')}
 
 ESTILO VISUAL DEFINIDO:
@@ -386,12 +1889,47 @@ REFERENCIAS VISUALES:
 {referencias}
 
 ELEMENTOS TÉCNICOS REQUERIDOS:
-Efectos visuales: {', '.join(analisis_previo.get('elementos_tecnicos', {}).get('efectos_visuales', ['No especificados']))}
-Gráficos/Animaciones: {', '.join(analisis_previo.get('elementos_tecnicos', {}).get('graficos_animaciones', ['No especificados']))}
-Post-producción: {', '.join(analisis_previo.get('elementos_tecnicos', {}).get('post_produccion', ['No especificados']))}
+Efectos visuales: {', '.join(elementos_tecnicos.get('efectos_visuales', ['No especificados']))}
+Gráficos/Animaciones: {', '.join(elementos_tecnicos.get('graficos_animaciones', ['No especificados']))}
+Post-producción: {', '.join(elementos_tecnicos.get('post_produccion', ['No especificados']))}"""
+
+    def _contexto_local(self, inicio, fin):
+        """Texto de los segmentos vecinos al grupo [inicio, fin).
+        
+        Con ventana_contexto_segmentos=None se envía el guion completo (coste cuadrático)."""
+        segmentos = self.segmentos_procesados
+        ventana = self.config.ventana_contexto_segmentos
+        if ventana is None:
+            return " ".join(s['texto'] for s in segmentos)
+        previos = " ".join(s['texto'] for s in segmentos[max(0, inicio - ventana):inicio])
+        posteriores = " ".join(s['texto'] for s in segmentos[fin:fin + ventana])
+        return f"[ANTES] {previos or '(inicio del guion)'}\n[DESPUÉS] {posteriores or '(final del guion)'}"
+
+    def _notificar_segmento_analizado(self, indice, segmento, analisis):
+        """Evento de progreso por segmento; al_marcador_parcial permite mostrar el marcador antes de que
+        terminen los demás grupos."""
+        self.segmentos_analizados.add(indice)
+        self.print_status(f"Segmento {indice + 1} analizado "
+                          f"({len(self.segmentos_analizados)}/{len(self.segmentos_procesados)})", "🎞️")
+        if self.al_marcador_parcial is not None:
+            self.al_marcador_parcial(indice, segmento, analisis)
+
+    async def _procesar_grupo_async(self, grupo, grupo_num, total_grupos, json_template, resumen_global, indice_inicio):
+        """Procesa un grupo de segmentos de manera asíncrona, utilizando el resumen global del guion
+        y solo los segmentos vecinos como contexto local."""
+        # Preparar el texto del grupo actual
+        segmentos_grupo = "\n".join(
+            [f"[GRUPO ACTUAL] Segmento {i+1}: \"{s['texto']}\" ({s['tiempo_inicio']:.2f}s -> {s['tiempo_fin']:.2f}s)"
+             for i, s in enumerate(grupo, start=indice_inicio)]
+        )
+        contexto_local = self._contexto_local(indice_inicio, indice_inicio + len(grupo))
 
-CONTEXTO COMPLETO DEL GUION:
-{contexto_completo}
+        prompt_analisis = f'''Analiza cada segmento y genera un plan visual detallado, considerando el análisis previo del guion y el contexto cercano.
+
+{resumen_global}
+
+CONTEXTO CERCANO DEL GUION:
+{contexto_local}
 
 SEGMENTOS A PROCESAR EN ESTE GRUPO:
 {segmentos_grupo}
@@ -416,7 +1954,7 @@ IMPORTANTE:
 2. Asegúrate de que cada elemento visual apoye la narrativa general
 3. Incluye solo los tipos de contenido que podrían mejorar la escena
 4. Mantén el mismo orden de los segmentos proporcionados
-5. Usa el contexto completo para crear transiciones coherentes
+5. Usa el contexto cercano para crear transiciones coherentes
 6. Evita repeticiones innecesarias de recursos visuales similares
 7. SOLO procesa los segmentos marcados como [GRUPO ACTUAL]
 8. Asegúrate de que las propuestas visuales sean consistentes con el análisis previo del guion
@@ -424,30 +1962,36 @@ IMPORTANTE:
 Devuelve solo JSON válido siguiendo esta plantilla:
 {json_template}'''
 
+        # Medir el tamaño real del prompt para poder comparar ventanas de contexto
+        tokens_prompt = self._contar_tokens(prompt_analisis)
+        self.tokens_prompt_grupos[grupo_num] = tokens_prompt
+
         # Logging del grupo usando el nuevo método
         with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
             f.write(f"\n{'='*100}\n")
             f.write(f"=== PROCESANDO GRUPO {grupo_num + 1}/{total_grupos} ===\n")
             f.write(f"Número de segmentos en este grupo: {len(grupo)}\n")
+            f.write(f"Tokens del prompt: {tokens_prompt}\n")
             f.write("Segmentos a procesar:\n")
             f.write(segmentos_grupo + "\n")
 
         try:
-            system_content = "Eres un director de arte y experto en visuales con amplia experiencia en post-producción. Tu tarea es crear planes visuales extremadamente detallados para cada segmento, especificando exactamente qué tipos de contenido visual se necesitan. Considera el análisis previo del guion y el contexto completo para mantener coherencia visual y narrativa."
+            system_content = "Eres un director de arte y experto en visuales con amplia experiencia en post-producción. Tu tarea es crear planes visuales extremadamente detallados para cada segmento, especificando exactamente qué tipos de contenido visual se necesitan. Considera el análisis previo del guion y el contexto cercano para mantener coherencia visual y narrativa."
             
-            # Llamada asíncrona a GPT-4
-            response = await self.async_client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
+            def al_recibir_elemento(indice, elemento):
+                if indice < len(grupo):
+                    self._notificar_segmento_analizado(indice_inicio + indice, grupo[indice], elemento)
+
+            # Llamada asíncrona a GPT-4 (en streaming si está activado)
+            respuesta = await self._llamada_gpt(
+                [
                     {"role": "system", "content": system_content},
                     {"role": "user", "content": prompt_analisis}
                 ],
                 temperature=0.7,
-                response_format={"type": "json_object"}
+                al_recibir_elemento=al_recibir_elemento
             )
 
-            respuesta = response.choices[0].message.content
-
             # Logging de la interacción
             with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
                 self._registrar_interaccion_gpt(f, f"ANÁLISIS VISUAL - GRUPO {grupo_num + 1}", 
@@ -462,53 +2006,163 @@ Devuelve solo JSON válido siguiendo esta plantilla:
             with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
                 f.write(f"\n=== ERROR EN GRUPO {grupo_num + 1} ===\n")
                 f.write(f"{error_msg}\n")
-            return grupo_num, []
+            # None marca el grupo como fallido para poder reintentarlo
+            return grupo_num, None
 
     async def analizar_segmentos_paralelo(self, json_template):
-        """Analiza todos los segmentos en paralelo usando asyncio, manteniendo el contexto completo."""
-        SEGMENTOS_POR_GRUPO = 12
-        grupos = [
-            self.segmentos_procesados[i:i + SEGMENTOS_POR_GRUPO]
-            for i in range(0, len(self.segmentos_procesados), SEGMENTOS_POR_GRUPO)
+        """Analiza todos los segmentos en paralelo usando asyncio.
+        
+        Cada grupo recibe el resumen global del guion (calculado una sola vez) y una ventana de
+        segmentos vecinos, de modo que el coste en tokens crece linealmente con la duración."""
+        # Coste de cada segmento: su línea en el prompt más la respuesta que se espera para él
+        TOKENS_FORMATO_SEGMENTO = 20
+        costes = [
+            self._contar_tokens(s['texto']) + TOKENS_FORMATO_SEGMENTO + self.config.tokens_respuesta_por_segmento
+            for s in self.segmentos_procesados
         ]
+        rangos = self._empaquetar_grupos(costes, self.config.tokens_por_grupo)
+        inicios = [inicio for inicio, _ in rangos]
+        grupos = [self.segmentos_procesados[inicio:fin] for inicio, fin in rangos]
 
-        # Preparar el contexto completo como texto fluido
-        contexto_completo = " ".join([s['texto'] for s in self.segmentos_procesados])
+        resumen_global = self._resumen_global_guion()
+        self.tokens_prompt_grupos = {}
+        self.segmentos_analizados = set()
 
         self.print_status(f"Procesando {len(self.segmentos_procesados)} segmentos en {len(grupos)} grupos en paralelo", "🚀")
 
         # Crear tareas para cada grupo
         tareas = [
-            self._procesar_grupo_async(grupo, i, len(grupos), json_template, contexto_completo)
+            self._procesar_grupo_async(grupo, i, len(grupos), json_template, resumen_global, inicios[i])
             for i, grupo in enumerate(grupos)
         ]
 
-        # Ejecutar todas las tareas en paralelo
-        resultados = await asyncio.gather(*tareas)
+        # Ejecutar todas las tareas en paralelo (el planificador limita las que están en vuelo)
+        resultados = dict(await asyncio.gather(*tareas))
 
-        # Ordenar resultados por número de grupo
-        resultados_ordenados = sorted(resultados, key=lambda x: x[0])
+        # Repetir solo los grupos que fallaron
+        for ronda in range(self.config.rondas_reintento_grupos):
+            fallidos = [i for i, analisis_grupo in resultados.items() if analisis_grupo is None]
+            if not fallidos:
+                break
+            self.print_status(f"Reintentando {len(fallidos)} grupos fallidos (ronda {ronda + 1})", "🔁")
+            resultados.update(await asyncio.gather(*[
+                self._procesar_grupo_async(grupos[i], i, len(grupos), json_template, resumen_global, inicios[i])
+                for i in fallidos
+            ]))
+
+        if self.tokens_prompt_grupos:
+            tokens = self.tokens_prompt_grupos.values()
+            self.print_status(
+                f"Tokens de prompt en análisis visual: {sum(tokens)} en total, {max(tokens)} máximo por grupo "
+                f"(ventana de contexto: {self.config.ventana_contexto_segmentos})", "📏")
         
-        # Extraer solo los análisis
+        # Extraer solo los análisis, ordenados por número de grupo
         todos_analisis = []
-        for _, analisis_grupo in resultados_ordenados:
-            todos_analisis.extend(analisis_grupo)
+        for i in sorted(resultados):
+            # Un grupo que sigue fallando aporta entradas vacías para no desalinear los siguientes
+            todos_analisis.extend(resultados[i] if resultados[i] is not None else [{}] * len(grupos[i]))
 
         return todos_analisis
 
-    async def segmentar_con_gpt(self):
-        """Versión actualizada que usa el análisis previo del guion para mejorar la segmentación."""
+    async def segmentar_con_gpt(self, usar_analisis=True, analisis_visual=True):
+        """Versión actualizada que usa el análisis previo del guion para mejorar la segmentación.
+        
+        Con usar_analisis=False segmenta solo a partir de la transcripción (sin esperar al análisis
+        del guion) y con analisis_visual=False se detiene tras asociar los tiempos.
+        
+        Las transcripciones largas se dividen en ventanas de palabras solapadas que se segmentan en
+        paralelo; cada solape se corta en un índice de palabra común a ambas ventanas."""
         self.print_status("Analizando transcripción con GPT-4...", "��")
         
-        # Obtener el texto completo sin tiempos
-        palabras_completas = [
-            word['word'].strip()
-            for segment in self.transcripcion.get('segments', [])
-            for word in segment.get('words', [])
-            if word['word'].strip()
-        ]
-        texto_completo = " ".join(palabras_completas)
+        palabras_whisper = self.palabras
+        ventanas = self._ventanas_segmentacion(len(palabras_whisper))
+        if len(ventanas) > 1:
+            self.print_status(f"Segmentando {len(palabras_whisper)} palabras en {len(ventanas)} ventanas en paralelo", "🚀")
+
+        try:
+            resultados = await asyncio.gather(*[
+                self._segmentar_ventana(palabras_whisper, inicio, fin, num, len(ventanas), usar_analisis)
+                for num, (inicio, fin) in enumerate(ventanas)
+            ])
+            self.segmentos_procesados.extend(self._reconciliar_ventanas(palabras_whisper, ventanas, resultados))
+
+            if analisis_visual:
+                await self.analizar_visual_segmentos()
+
+        except Exception as e:
+            error_msg = f"Error en la segmentación: {str(e)}"
+            self.print_status(error_msg, "❌")
+            with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
+                f.write("\n=== ERROR EN SEGMENTACIÓN ===\n")
+                f.write(error_msg + "\n")
+            raise
+
+    def _ventanas_segmentacion(self, num_palabras):
+        """Rangos [inicio, fin) de palabras que se segmentan por separado, solapados entre sí."""
+        tamano = self.config.palabras_por_ventana_segmentacion
+        if tamano is None or num_palabras <= tamano:
+            return [(0, num_palabras)]
+        solape = min(self.config.solape_ventana_segmentacion, tamano // 2)
+        paso = tamano - solape
+        ventanas = []
+        for inicio in range(0, num_palabras, paso):
+            fin = min(inicio + tamano, num_palabras)
+            ventanas.append((inicio, fin))
+            if fin == num_palabras:
+                break
+        return ventanas
+
+    def _reconciliar_ventanas(self, palabras_whisper, ventanas, resultados):
+        """Une los segmentos de ventanas consecutivas de forma determinista.
         
+        Cada solape se corta en un índice de palabra: el inicio de segmento común a ambas ventanas más
+        cercano al centro del solape o, si no hay ninguno, la palabra central. La ventana anterior se
+        queda con las palabras antes del corte y la siguiente con el resto; el segmento que cruza el
+        corte se recorta, de modo que cada palabra pertenece a un único segmento."""
+        rangos = [[self._rango_palabras(palabras_whisper, s) for s in segmentos_ventana]
+                  for segmentos_ventana in resultados]
+        cortes = [0]
+        for num, ((_, fin_anterior), (inicio_siguiente, _)) in enumerate(zip(ventanas, ventanas[1:])):
+            medio = (inicio_siguiente + fin_anterior) // 2
+            comunes = ({a for a, _ in rangos[num]} & {a for a, _ in rangos[num + 1]}
+                       & set(range(inicio_siguiente + 1, fin_anterior)))
+            cortes.append(min(comunes, key=lambda i: (abs(i - medio), i)) if comunes else medio)
+        cortes.append(len(palabras_whisper))
+
+        segmentos = []
+        for num, segmentos_ventana in enumerate(resultados):
+            desde, hasta = cortes[num], cortes[num + 1]
+            for segmento, (a, b) in zip(segmentos_ventana, rangos[num]):
+                if b <= a:
+                    # Segmento sin palabras propias: se asigna por su posición
+                    if desde <= a < hasta:
+                        segmentos.append(segmento)
+                    continue
+                a_recortado, b_recortado = max(a, desde), min(b, hasta)
+                if b_recortado <= a_recortado:
+                    continue
+                if (a_recortado, b_recortado) != (a, b):
+                    segmento = dict(segmento,
+                                    texto=palabras_whisper.texto(a_recortado, b_recortado),
+                                    tiempo_inicio=palabras_whisper.inicio(a_recortado),
+                                    tiempo_fin=palabras_whisper.fin(b_recortado - 1))
+                segmentos.append(segmento)
+        return segmentos
+
+    @staticmethod
+    def _rango_palabras(palabras_whisper, segmento):
+        """Rango [a, b) de palabras de Whisper que cubre un segmento según sus tiempos."""
+        # Los tiempos de los segmentos están redondeados a ms; se tolera medio ms de diferencia
+        tolerancia = 0.5 * 10 ** -LineaTiempoPalabras.DECIMALES
+        a = int(np.searchsorted(palabras_whisper.inicios, segmento['tiempo_inicio'] - tolerancia, side='left'))
+        b = int(np.searchsorted(palabras_whisper.fines, segmento['tiempo_fin'] + tolerancia, side='right'))
+        return a, b
+
+    def _prompts_segmentacion(self, texto, usar_analisis, por_indices=False):
+        """System prompt y prompt de segmentación para un fragmento de la transcripción.
+        
+        Con por_indices=True el texto lleva cada palabra numerada y se piden solo los índices de
+        inicio de cada segmento en lugar de su texto."""
         # Preparar el contexto del análisis previo
         analisis_previo = self.proyecto.metadata["analisis_guion"]
         momentos_clave = "\n".join([
@@ -526,15 +2180,9 @@ Atmósfera: {estilo_visual.get('atmosfera', 'No especificada')}
 Paleta de colores: {', '.join(estilo_visual.get('paleta_colores', ['No especificada']))}
 """
         
-        # Preparar prompts para GPT-4
-        system_prompt = (
-            """Eres un experto en análisis narrativo, dirección de arte y edición de video.
-Tu tarea es segmentar voice-overs en unidades coherentes siguiendo reglas específicas y el análisis previo del guion.
-Mantén los tiempos exactos de cada palabra y genera descripciones visuales evocadoras que sean consistentes con el análisis general."""
-        )
-        
-        prompt_segmentacion = f'''Analiza y segmenta este texto considerando el análisis previo del guion y estas reglas específicas:
-
+        if usar_analisis:
+            encabezado = "Analiza y segmenta este texto considerando el análisis previo del guion y estas reglas específicas:"
+            contexto_analisis = f'''
 ANÁLISIS PREVIO DEL GUION:
 Tema principal: {analisis_previo.get('tema_principal', 'No especificado')}
 Tono: {analisis_previo.get('tono', 'No especificado')}
@@ -546,7 +2194,59 @@ ESTILO VISUAL DEFINIDO:
 
 MOMENTOS CLAVE IDENTIFICADOS:
 {momentos_clave}
+'''
+        else:
+            encabezado = "Analiza y segmenta este texto siguiendo estas reglas específicas:"
+            contexto_analisis = ""
+
+        # Sin análisis previo (modo concurrente) no se menciona nada que el modelo no tenga
+        if usar_analisis:
+            system_prompt = (
+                """Eres un experto en análisis narrativo, dirección de arte y edición de video.
+Tu tarea es segmentar voice-overs en unidades coherentes siguiendo reglas específicas y el análisis previo del guion.
+Mantén los tiempos exactos de cada palabra y genera descripciones visuales evocadoras que sean consistentes con el análisis general."""
+            )
+            considerar = """  * Inicio y fin de ideas
+  * Puntos de énfasis identificados en el análisis
+  * Transiciones narrativas
+  * Momentos clave del análisis previo"""
+            objetivos = """1. Crear unidades visuales potentes que respeten los momentos clave identificados
+2. Tengan ritmo natural para edición
+3. Enfatizar los puntos de mayor impacto
+4. Facilitar las transiciones entre ideas principales
+5. Mantener el ritmo narrativo establecido en el análisis"""
+        else:
+            system_prompt = (
+                """Eres un experto en análisis narrativo, dirección de arte y edición de video.
+Tu tarea es segmentar voice-overs en unidades coherentes siguiendo reglas específicas.
+Mantén los tiempos exactos de cada palabra."""
+            )
+            considerar = """  * Inicio y fin de ideas
+  * Puntos de énfasis del discurso
+  * Transiciones narrativas"""
+            objetivos = """1. Crear unidades visuales potentes
+2. Tengan ritmo natural para edición
+3. Enfatizar los puntos de mayor impacto
+4. Facilitar las transiciones entre ideas principales
+5. Mantener el ritmo narrativo del texto"""
+        
+        if por_indices:
+            formato_respuesta = '''- Cada palabra del texto va seguida de su índice entre corchetes, p. ej. "Hola[0] mundo[1]"
+- NO repitas el texto: indica solo el índice de la primera palabra de cada segmento, en orden creciente y empezando por 0
+- Devuelve solo JSON válido con el siguiente formato:
+{
+    "inicios": [0, 7, 15]
+}'''
+        else:
+            formato_respuesta = '''- Devuelve solo JSON válido con el siguiente formato:
+{
+    "segmentos": [
+        {"texto": "texto exacto del segmento"}
+    ]
+}'''
 
+        return system_prompt, f'''{encabezado}
+{contexto_analisis}
 REGLAS DE SEGMENTACIÓN:
 - Segmentos de 1-20 palabras basada en unidades narrativas
 - Separar en nuevo segmento por:
@@ -557,31 +2257,32 @@ REGLAS DE SEGMENTACIÓN:
 - Cada segmento debe representar una idea o momento narrativo completo
 - Respetar pausas naturales del discurso
 - Considerar:
-  * Inicio y fin de ideas
-  * Puntos de énfasis identificados en el análisis
-  * Transiciones narrativas
-  * Momentos clave del análisis previo
+{considerar}
 
 OBJETIVOS DE LA SEGMENTACIÓN:
-1. Crear unidades visuales potentes que respeten los momentos clave identificados
-2. Tengan ritmo natural para edición
-3. Enfatizar los puntos de mayor impacto
-4. Facilitar las transiciones entre ideas principales
-5. Mantener el ritmo narrativo establecido en el análisis
+{objetivos}
 
-- Devuelve solo JSON válido con el siguiente formato:
-{{
-    "segmentos": [
-        {{"texto": "texto exacto del segmento"}}
-    ]
-}}
+{formato_respuesta}
 
 Texto a procesar:
-{texto_completo}
+{texto}
 '''
+
+    async def _segmentar_ventana(self, palabras_whisper, inicio, fin, num_ventana, total_ventanas, usar_analisis):
+        """Segmenta con GPT las palabras [inicio, fin) y asocia tiempos a los segmentos devueltos."""
+        palabras_ventana = palabras_whisper[inicio:fin]
+        por_indices = self.config.protocolo_segmentacion == "indices"
+        if por_indices:
+            texto_ventana = " ".join(f"{texto}[{i}]" for i, texto in enumerate(palabras_ventana.textos))
+        else:
+            texto_ventana = palabras_ventana.texto()
+        system_prompt, prompt_segmentacion = self._prompts_segmentacion(texto_ventana, usar_analisis, por_indices)
+        fase = "segmentacion" if total_ventanas == 1 else f"segmentacion_{num_ventana + 1}"
+        etiqueta = "" if total_ventanas == 1 else f" - VENTANA {num_ventana + 1}/{total_ventanas}"
+
         # Guardar el prompt en el archivo de análisis
         with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
-            f.write("\n=== MENSAJES ENVIADOS A GPT-4 (SEGMENTACIÓN) ===\n")
+            f.write(f"\n=== MENSAJES ENVIADOS A GPT-4 (SEGMENTACIÓN{etiqueta}) ===\n")
             f.write("System message:\n")
             f.write(system_prompt + "\n\n")
             f.write("User message:\n")
@@ -592,65 +2293,136 @@ Texto a procesar:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt_segmentacion}
         ]
-        response_segmentacion = self.client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=messages,
-            temperature=0.5,
-            response_format={"type": "json_object"}
-        )
-        respuesta_seg = response_segmentacion.choices[0].message.content
+        respuesta_seg = await self._llamada_gpt(messages, temperature=0.5)
 
         with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
-            f.write("=== RESPUESTA DE GPT-4 (SEGMENTACIÓN) ===\n")
+            f.write(f"=== RESPUESTA DE GPT-4 (SEGMENTACIÓN{etiqueta}) ===\n")
             f.write(respuesta_seg + "\n")
             self._registrar_uso_tokens(f, messages, respuesta_seg)
         
-        self.proyecto.guardar_prompt("segmentacion", system_prompt, prompt_segmentacion, respuesta_seg)
+        self.proyecto.guardar_prompt(fase, system_prompt, prompt_segmentacion, respuesta_seg)
 
-        try:
-            segmentacion = json.loads(respuesta_seg)
-            segmentos_narrativos = segmentacion.get('segmentos', [])
-            self.print_status("Asociando tiempos a segmentos...", "⏱️")
-
-            # Preprocesar palabras de Whisper
-            palabras_whisper = []
-            for segment in self.transcripcion.get('segments', []):
-                for word in segment.get('words', []):
-                    if word['word'].strip():
-                        palabras_whisper.append({
-                            'texto': word['word'].strip(),
-                            'inicio': float(word['start']),
-                            'fin': float(word['end']),
-                            'indice': len(palabras_whisper)
-                        })
-
-            # Crear un índice invertido: palabra normalizada -> lista de ocurrencias
-            indice_palabras = defaultdict(list)
-            for palabra in palabras_whisper:
-                texto_norm = self.normalizar_texto(palabra['texto'])
-                indice_palabras[texto_norm].append(palabra)
-
-            ultima_posicion = 0
-            for segmento in segmentos_narrativos:
-                texto_segmento = segmento['texto']
-                inicio, fin, score = self.encontrar_mejor_secuencia(texto_segmento, ultima_posicion, palabras_whisper, indice_palabras)
-                if inicio is not None and score > 70:
-                    self.segmentos_procesados.append({
-                        'texto': texto_segmento,
-                        'tiempo_inicio': inicio,
-                        'tiempo_fin': fin,
-                        'score_matching': score
-                    })
-                    ultima_posicion = next(
-                        (i for i, p in enumerate(palabras_whisper) if p['fin'] > fin),
-                        ultima_posicion + 1
-                    )
-                    self.print_status(f"✓ Segmento matcheado (score: {score:.1f}%): {texto_segmento}", "🎯")
-                else:
-                    self.print_status(f"⚠️ No se encontró coincidencia confiable para: {texto_segmento}", "⚠️")
+        segmentacion = json.loads(respuesta_seg)
+        if por_indices:
+            return self._segmentos_desde_indices(segmentacion.get('inicios', []), palabras_ventana)
+        segmentos_narrativos = segmentacion.get('segmentos', [])
+        self.print_status(f"Asociando tiempos a segmentos{etiqueta.lower()}...", "⏱️")
+        if self.config.alineador == "global":
+            return self._alinear_segmentos_global(segmentos_narrativos, palabras_ventana)
+        return self._alinear_segmentos(segmentos_narrativos, palabras_ventana)
+
+    @staticmethod
+    def _segmentos_desde_indices(inicios, palabras_whisper):
+        """Construye los segmentos a partir de los índices de su primera palabra, en O(n).
+        
+        Los tiempos salen directamente de las palabras de Whisper; se descartan índices no enteros
+        (incluidos true/false de JSON), fuera de rango o repetidos y siempre se empieza en la palabra 0."""
+        if not palabras_whisper:
+            return []
+        validos = {i for i in inicios
+                   if isinstance(i, int) and not isinstance(i, bool) and 0 < i < len(palabras_whisper)}
+        cortes = [0] + sorted(validos) + [len(palabras_whisper)]
+        return [
+            {
+                'texto': palabras_whisper.texto(inicio, fin),
+                'tiempo_inicio': palabras_whisper.inicio(inicio),
+                'tiempo_fin': palabras_whisper.fin(fin - 1),
+                'score_matching': 100.0
+            }
+            for inicio, fin in zip(cortes[:-1], cortes[1:])
+        ]
+
+    def _alinear_segmentos_global(self, segmentos_narrativos, palabras_whisper):
+        """Asocia tiempos a todos los segmentos con una única alineación global (AlineadorGlobal).
+        
+        No descarta segmentos: los que no tienen ninguna palabra emparejada ocupan el hueco entre
+        sus vecinos y su score refleja la proporción y calidad de las palabras emparejadas."""
+        if not palabras_whisper:
+            return []
+        textos_whisper = palabras_whisper.textos_normalizados()
+        palabras_gpt, segmento_de = [], []
+        for num, segmento in enumerate(segmentos_narrativos):
+            for palabra in segmento['texto'].split():
+                texto_norm = self.normalizar_texto(palabra)
+                if texto_norm:
+                    palabras_gpt.append(texto_norm)
+                    segmento_de.append(num)
+
+        alineacion = AlineadorGlobal.alinear(palabras_gpt, textos_whisper,
+                                             banda=self.config.banda_alineacion,
+                                             workers=self.presupuesto.hilos_alineacion)
+
+        # Primera y última palabra de Whisper emparejada con cada segmento, y similitud acumulada
+        rangos = [None] * len(segmentos_narrativos)
+        similitud = [0.0] * len(segmentos_narrativos)
+        palabras_por_segmento = [0] * len(segmentos_narrativos)
+        for num, (indice, score) in zip(segmento_de, alineacion):
+            palabras_por_segmento[num] += 1
+            if indice < 0:
+                continue
+            similitud[num] += score
+            rangos[num] = (indice, indice) if rangos[num] is None else (rangos[num][0], indice)
+
+        segmentos_alineados = []
+        fin_anterior = palabras_whisper.inicio(0)
+        for num, segmento in enumerate(segmentos_narrativos):
+            if rangos[num] is not None:
+                inicio = palabras_whisper.inicio(rangos[num][0])
+                fin = palabras_whisper.fin(rangos[num][1])
+            else:
+                # Sin palabras emparejadas: ocupar el hueco hasta el siguiente segmento emparejado
+                siguiente = next((r for r in rangos[num + 1:] if r is not None), None)
+                inicio = fin_anterior
+                fin = palabras_whisper.inicio(siguiente[0]) if siguiente else palabras_whisper.fin(-1)
+                fin = max(inicio, fin)
+            score = similitud[num] / palabras_por_segmento[num] if palabras_por_segmento[num] else 0.0
+            segmentos_alineados.append({
+                'texto': segmento['texto'],
+                'tiempo_inicio': inicio,
+                'tiempo_fin': fin,
+                'score_matching': score
+            })
+            fin_anterior = fin
+            if score > 70:
+                self.print_status(f"✓ Segmento alineado (score: {score:.1f}%): {segmento['texto']}", "🎯")
+            else:
+                self.print_status(f"⚠️ Alineación de baja confianza (score: {score:.1f}%): {segmento['texto']}", "⚠️")
+        return segmentos_alineados
+
+    def _alinear_segmentos(self, segmentos_narrativos, palabras_whisper):
+        """Asocia a cada segmento de texto los tiempos de las palabras de Whisper que le corresponden."""
+        # Normalizar cada palabra una sola vez y crear un índice invertido:
+        # palabra normalizada -> posiciones (crecientes) de sus ocurrencias
+        textos_norm = palabras_whisper.textos_normalizados()
+        indice_palabras = defaultdict(list)
+        for i, texto_norm in enumerate(textos_norm):
+            indice_palabras[texto_norm].append(i)
+
+        segmentos_alineados = []
+        ultima_posicion = 0
+        for segmento in segmentos_narrativos:
+            texto_segmento = segmento['texto']
+            inicio, fin, score = self.encontrar_mejor_secuencia(texto_segmento, ultima_posicion, palabras_whisper,
+                                                                indice_palabras, textos_norm)
+            if inicio is not None and score > 70:
+                segmentos_alineados.append({
+                    'texto': texto_segmento,
+                    'tiempo_inicio': inicio,
+                    'tiempo_fin': fin,
+                    'score_matching': score
+                })
+                # Primera palabra que termina después del segmento (los fines son crecientes)
+                siguiente = int(np.searchsorted(palabras_whisper.fines, np.float32(fin), side='right'))
+                ultima_posicion = siguiente if siguiente < len(palabras_whisper) else ultima_posicion + 1
+                self.print_status(f"✓ Segmento matcheado (score: {score:.1f}%): {texto_segmento}", "🎯")
+            else:
+                self.print_status(f"⚠️ No se encontró coincidencia confiable para: {texto_segmento}", "⚠️")
+        return segmentos_alineados
 
-            # Realizar el análisis visual de los segmentos
-            json_template = '''{
+    async def analizar_visual_segmentos(self):
+        """Añade el análisis visual a los segmentos ya alineados (necesita el análisis del guion)."""
+        # Realizar el análisis visual de los segmentos
+        json_template = '''{
     "analisis_segmentos": [
         {
             "texto": "texto exacto del segmento",
@@ -668,50 +2440,45 @@ Texto a procesar:
         }
     ]
 }'''
-            # Analizar los segmentos en paralelo
-            todos_analisis = await self.analizar_segmentos_paralelo(json_template)
-            
-            # Actualizar los segmentos procesados con el análisis visual
-            for i, analisis in enumerate(todos_analisis):
-                if i < len(self.segmentos_procesados):
-                    self.segmentos_procesados[i].update({
-                        'descripcion_visual': analisis.get('descripcion_visual', ''),
-                        'storyboard': analisis.get('storyboard', ''),
-                        'tipo_visual': json.dumps(analisis.get('tipo_visual', {}), ensure_ascii=False),
-                        'palabras_clave': analisis.get('palabras_clave', [])
-                    })
-
-        except Exception as e:
-            error_msg = f"Error en la segmentación: {str(e)}"
-            self.print_status(error_msg, "❌")
-            with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
-                f.write("\n=== ERROR EN SEGMENTACIÓN ===\n")
-                f.write(error_msg + "\n")
-            raise
-
-    def encontrar_mejor_secuencia(self, texto_segmento, ultima_pos, palabras_whisper, indice_palabras):
-        """Busca la mejor coincidencia de la secuencia en la transcripción."""
+        # Analizar los segmentos en paralelo
+        todos_analisis = await self.analizar_segmentos_paralelo(json_template)
+        
+        # Actualizar los segmentos procesados con el análisis visual
+        for i, analisis in enumerate(todos_analisis):
+            if i < len(self.segmentos_procesados):
+                tipo_visual = analisis.get('tipo_visual', {})
+                self.segmentos_procesados[i].update({
+                    'descripcion_visual': analisis.get('descripcion_visual', ''),
+                    'storyboard': analisis.get('storyboard', ''),
+                    'tipo_visual': tipo_visual if isinstance(tipo_visual, dict) else {},
+                    'palabras_clave': analisis.get('palabras_clave', [])
+                })
+
+    def encontrar_mejor_secuencia(self, texto_segmento, ultima_pos, palabras_whisper, indice_palabras, textos_norm):
+        """Busca la mejor coincidencia de la secuencia en la transcripción.
+        
+        indice_palabras asocia cada palabra normalizada a sus posiciones y textos_norm contiene las
+        palabras de Whisper ya normalizadas. Solo se prueban inicios dentro de la ventana de búsqueda."""
         palabras_segmento = [self.normalizar_texto(p) for p in texto_segmento.split()]
+        if not palabras_segmento:
+            return None, None, 0
         mejor_inicio, mejor_fin, mejor_score = None, None, 0
+        limite = min(len(palabras_whisper), ultima_pos + self.config.ventana_busqueda_alineacion)
         primera_palabra = palabras_segmento[0]
-        candidatos_inicio = []
-        if primera_palabra in indice_palabras:
-            candidatos_inicio.extend(p['indice'] for p in indice_palabras[primera_palabra] if p['indice'] >= ultima_pos)
+        posiciones = indice_palabras.get(primera_palabra, [])
+        candidatos_inicio = posiciones[bisect.bisect_left(posiciones, ultima_pos):bisect.bisect_left(posiciones, limite)]
         if not candidatos_inicio:
             matches = process.extract(
                 primera_palabra,
-                [p['texto'] for p in palabras_whisper[ultima_pos:]],
+                textos_norm[ultima_pos:limite],
                 scorer=fuzz.ratio,
                 limit=3
             )
-            candidatos_inicio.extend(i + ultima_pos for i, (_, score) in enumerate(matches) if score > 80)
+            candidatos_inicio = sorted(ultima_pos + i for _, score, i in matches if score > 80)
         for pos_inicio in candidatos_inicio:
             if pos_inicio + len(palabras_segmento) > len(palabras_whisper):
                 continue
-            secuencia_whisper = [
-                self.normalizar_texto(palabras_whisper[i]['texto'])
-                for i in range(pos_inicio, pos_inicio + len(palabras_segmento))
-            ]
+            secuencia_whisper = textos_norm[pos_inicio:pos_inicio + len(palabras_segmento)]
             score_total = sum(
                 fuzz.ratio(w1, w2) for w1, w2 in zip(palabras_segmento, secuencia_whisper)
             ) / len(palabras_segmento)
@@ -722,71 +2489,49 @@ Texto a procesar:
             if score_total > 95:
                 break
         if mejor_inicio is not None:
-            return palabras_whisper[mejor_inicio]['inicio'], palabras_whisper[mejor_fin]['fin'], mejor_score
+            return palabras_whisper.inicio(mejor_inicio), palabras_whisper.fin(mejor_fin), mejor_score
         return None, None, 0
 
     def generar_srt_nuevo(self):
-        """Genera el archivo SRT final usando los datos estructurados del proyecto."""
+        """Genera el archivo SRT final a partir de los marcadores precalculados del proyecto."""
         self.print_status("Generando archivo SRT final...", "📝")
         with open(self.srt_path, 'w', encoding='utf-8') as f:
-            for i, segmento in enumerate(self.proyecto.segmentos, 1):
-                f.write(f"{i}\n")
-                tiempo_inicio = Util.segundos_a_srt(segmento.tiempo_inicio)
-                tiempo_fin = Util.segundos_a_srt(segmento.tiempo_fin)
+            for marcador in self.proyecto.marcadores:
+                f.write(f"{marcador.numero}\n")
+                tiempo_inicio = Util.segundos_a_srt(marcador.tiempo_inicio)
+                tiempo_fin = Util.segundos_a_srt(marcador.tiempo_fin)
                 f.write(f"{tiempo_inicio} --> {tiempo_fin}\n")
-
-                # Procesar tipo_visual para mostrar solo los elementos con contenido
-                tipo_visual_dict = segmento.tipo_visual
-                if isinstance(tipo_visual_dict, str):
-                    try:
-                        tipo_visual_dict = json.loads(tipo_visual_dict)
-                    except json.JSONDecodeError:
-                        tipo_visual_dict = {}
-                
-                tipo_visual_formateado = []
-                if isinstance(tipo_visual_dict, dict):
-                    for key, value in tipo_visual_dict.items():
-                        if value and len(value) > 0:
-                            elementos = value if isinstance(value, list) else [value]
-                            for elemento in elementos:
-                                tipo_visual_formateado.append(f"{key}: {elemento}")
-                
-                tipo_visual_str = "\n".join(tipo_visual_formateado) if tipo_visual_formateado else "Sin elementos visuales"
-                
-                palabras_clave = (
-                    ', '.join(segmento.palabras_clave)
-                    if isinstance(segmento.palabras_clave, list)
-                    else segmento.palabras_clave if segmento.palabras_clave
-                    else "Sin palabras clave"
-                )
-
-                # Formatear el subtítulo con el formato exacto deseado
-                subtitulo = f'''DESCRIPCIÓN VISUAL:
-{segmento.descripcion_visual or "Sin descripción visual"}
-
-STORYBOARD:
-{segmento.storyboard or "Sin storyboard"}
-
-TIPO VISUAL:
-{tipo_visual_str}
-
-PALABRAS CLAVE:
-{palabras_clave}
-
-TEXTO:
-{segmento.texto}
-'''
-                f.write(f"{subtitulo}\n")
+                f.write(f"{marcador.comentario(con_valores_por_defecto=True)}\n\n")
     
+    def _duracion_en_frames(self, audio_path, fps=30):
+        """Duración del audio en frames (al menos hasta el final del último marcador)."""
+        try:
+            segundos = sf.info(audio_path).duration
+        except Exception:
+            # m4a y otros formatos que libsndfile no lee: ffprobe solo lee la cabecera, sin decodificar
+            try:
+                segundos = float(mediainfo(audio_path)['duration'])
+            except Exception as e:
+                logger.info(f"⚠️ No se pudo leer la duración de {audio_path}: {e}")
+                segundos = 0.0
+        frames = int(np.ceil(segundos * fps))
+        return max([frames] + [marcador.frame_fin for marcador in self.proyecto.marcadores])
+
     def generar_xml_nuevo(self, audio_path):
-        """Genera el archivo XML final para Premiere, con los marcadores correspondientes."""
+        """Genera el archivo XML final para Premiere, con los marcadores correspondientes.
+        
+        Se escribe en streaming sobre un fichero con buffer; la duración de la secuencia es la del audio."""
         self.print_status("Generando archivo XML final...", "🎬")
-        xml = f'''<?xml version="1.0" encoding="UTF-8"?>
+        duracion = self._duracion_en_frames(audio_path)
+        nombre_audio = escapar_xml(os.path.basename(audio_path))
+        url_audio = escapar_xml(Path(os.path.abspath(audio_path)).as_uri())
+        nombre_secuencia = escapar_xml(f"MoodboardXZ_{self.project_folder}")
+        cabecera = f'''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE xmeml>
 <xmeml version="5">
     <sequence>
-        <name>MoodboardXZ_{self.project_folder}</name>
-        <duration>7200</duration>
+        <name>{nombre_secuencia}</name>
+        <duration>{duracion}</duration>
         <rate>
             <timebase>30</timebase>
             <ntsc>TRUE</ntsc>
@@ -807,20 +2552,20 @@ TEXTO:
                     <enabled>TRUE</enabled>
                     <locked>FALSE</locked>
                     <clipitem id="audio_1">
-                        <name>{os.path.basename(audio_path)}</name>
-                        <duration>7200</duration>
+                        <name>{nombre_audio}</name>
+                        <duration>{duracion}</duration>
                         <rate>
                             <timebase>30</timebase>
                             <ntsc>TRUE</ntsc>
                         </rate>
                         <file id="file_1">
-                            <name>{os.path.basename(audio_path)}</name>
-                            <pathurl>file://{os.path.abspath(audio_path)}</pathurl>
+                            <name>{nombre_audio}</name>
+                            <pathurl>{url_audio}</pathurl>
                             <rate>
                                 <timebase>30</timebase>
                                 <ntsc>TRUE</ntsc>
                             </rate>
-                            <duration>7200</duration>
+                            <duration>{duracion}</duration>
                             <media>
                                 <audio>
                                     <samplecharacteristics>
@@ -835,88 +2580,34 @@ TEXTO:
                             <mediatype>audio</mediatype>
                         </sourcetrack>
                         <in>0</in>
-                        <out>7200</out>
+                        <out>{duracion}</out>
                         <start>0</start>
-                        <end>7200</end>
+                        <end>{duracion}</end>
                     </clipitem>
                 </track>
             </audio>
         </media>
         <markers>'''
-        for i, segmento in enumerate(self.proyecto.segmentos, 1):
-            start_frame = Util.segundos_a_frames(segmento.tiempo_inicio)
-            end_frame = Util.segundos_a_frames(segmento.tiempo_fin)
-            if start_frame >= end_frame:
-                end_frame = start_frame + 1
-            texto = segmento.texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            idea = segmento.descripcion_visual.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            
-            # Procesar tipo_visual para mostrar solo los elementos con contenido
-            tipo_visual_dict = segmento.tipo_visual
-            if isinstance(tipo_visual_dict, str):
-                try:
-                    tipo_visual_dict = json.loads(tipo_visual_dict)
-                except json.JSONDecodeError:
-                    tipo_visual_dict = {}
-            
-            tipo_visual_formateado = []
-            if isinstance(tipo_visual_dict, dict):
-                for key, value in tipo_visual_dict.items():
-                    if value and len(value) > 0:
-                        elementos = value if isinstance(value, list) else [value]
-                        for elemento in elementos:
-                            # Escapar caracteres especiales que podrían causar problemas en XML
-                            elemento_escapado = elemento.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
-                            tipo_visual_formateado.append(f"{key}: {elemento_escapado}")
-            
-            tipo_visual_str = "\n".join(tipo_visual_formateado)
-            
-            palabras_clave = (
-                ', '.join(segmento.palabras_clave)
-                if isinstance(segmento.palabras_clave, list)
-                else segmento.palabras_clave
-            )
-            palabras_clave = palabras_clave.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            
-            # Formatear el título del marcador para incluir la idea principal
-            marker_title = f"[{i}] {idea[:100]}"  # Limitar a 100 caracteres para evitar títulos muy largos
-            
-            # Formatear la descripción del marcador
-            comment = f"""DESCRIPCIÓN VISUAL:
-{idea}
-
-STORYBOARD:
-{segmento.storyboard}
-
-TIPO VISUAL:
-{tipo_visual_str}
-
-PALABRAS CLAVE:
-{palabras_clave}
-
-TEXTO:
-{texto}""".replace('\n', '&#xA;')  # Convertir saltos de línea a entidad XML
-            
-            xml += f'''
+        with open(self.xml_path, "w", encoding='utf-8', buffering=1024 * 1024) as f:
+            f.write(cabecera)
+            for marcador in self.proyecto.marcadores:
+                f.write(f'''
             <marker>
-                <name>{marker_title}</name>
-                <comment>{comment}</comment>
-                <in>{start_frame}</in>
-                <out>{end_frame}</out>
-            </marker>'''
-        xml += '''
+                <name>{marcador.nombre_xml}</name>
+                <comment>{marcador.comentario_xml}</comment>
+                <in>{marcador.frame_inicio}</in>
+                <out>{marcador.frame_fin}</out>
+            </marker>''')
+            f.write('''
         </markers>
     </sequence>
-</xmeml>'''
-        with open(self.xml_path, "w", encoding='utf-8') as f:
-            f.write(xml)
-        self.print_status(f"XML generado con {len(self.proyecto.segmentos)} marcadores", "✅")
+</xmeml>''')
+        self.print_status(f"XML generado con {len(self.proyecto.marcadores)} marcadores", "✅")
         self.print_status("Marcadores generados:", "📍")
-        for i, segmento in enumerate(self.proyecto.segmentos, 1):
-            inicio = Util.segundos_a_frames(segmento.tiempo_inicio)
-            fin = Util.segundos_a_frames(segmento.tiempo_fin)
+        for marcador in self.proyecto.marcadores:
             self.print_status(
-                f"Marcador {i}: Frame {inicio} -> {fin} ({segmento.tiempo_inicio:.2f}s -> {segmento.tiempo_fin:.2f}s)",
+                f"Marcador {marcador.numero}: Frame {marcador.frame_inicio} -> {marcador.frame_fin} "
+                f"({marcador.tiempo_inicio:.2f}s -> {marcador.tiempo_fin:.2f}s)",
                 "🔖"
             )
     
@@ -925,13 +2616,7 @@ TEXTO:
         self.print_status("Analizando el guion completo...", "📚")
         
         # Obtener el texto completo sin tiempos
-        palabras_completas = [
-            word['word'].strip()
-            for segment in self.transcripcion.get('segments', [])
-            for word in segment.get('words', [])
-            if word['word'].strip()
-        ]
-        texto_completo = " ".join(palabras_completas)
+        texto_completo = self.palabras.texto()
         
         # Preparar prompts para el análisis del guion
         system_prompt = """Eres un experto guionista y director de arte con amplia experiencia en análisis de guiones y dirección visual.
@@ -1020,18 +2705,14 @@ Devuelve solo JSON válido con el siguiente formato:
 
         try:
             # Llamada a GPT-4 para el análisis del guion
-            response_analisis = self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
+            respuesta = await self._llamada_gpt(
+                [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt_analisis}
                 ],
-                temperature=0.7,
-                response_format={"type": "json_object"}
+                temperature=0.7
             )
             
-            respuesta = response_analisis.choices[0].message.content
-            
             # Registrar la interacción en el archivo de análisis
             with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
                 self._registrar_interaccion_gpt(f, "ANÁLISIS DEL GUION", system_prompt, prompt_analisis, respuesta)
@@ -1052,53 +2733,96 @@ Devuelve solo JSON válido con el siguiente formato:
                 f.write(error_msg + "\n")
             raise
 
-    async def procesar_audio(self, archivo_audio=None):
-        """Proceso completo: desde la preparación del audio hasta la generación de SRT y XML."""
-        self.print_status("Iniciando procesamiento...", "🚀")
+    def iniciar_registro(self):
+        """Crea el archivo de análisis GPT con la cabecera de configuración."""
         with open(self.gpt_analysis_path, 'w', encoding='utf-8') as f:
             f.write("=== CONFIGURACIÓN ===\n")
             f.write(f"Modelo: gpt-4-turbo-preview\n")
             f.write(f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+    
+    def registrar_error(self, e):
+        """Informa de un error del procesamiento y lo deja en el archivo de análisis."""
+        self.print_status(f"Error en el procesamiento: {str(e)}", "❌")
+        with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
+            f.write("\n=== ERROR EN EL PROCESAMIENTO ===\n")
+            f.write(f"Error: {str(e)}\n")
+    
+    def preparar_y_transcribir(self, audio_path):
+        """Etapa de audio (CPU): silencios, asset y transcripción. Devuelve el audio que referencia el XML."""
+        self.print_status(f"Procesando archivo: {os.path.basename(audio_path)}", "🎙")
+        if self.config.silencios_no_destructivos:
+            # Sin render intermedio: el XML referencia el archivo original intacto
+            audio = AudioDecodificado.decodificar(audio_path, con_original=False)
+            mapa_tiempos = self.eliminar_silencios_pcm(audio, solo_mapa=True)
+            self.transcribir_audio(audio.recortar(mapa_tiempos.intervalos_ms).pcm_16k, mapa_tiempos)
+            return os.path.abspath(audio_path)
+        if self.config.modo_audio == "ffmpeg":
+            pcm_16k, audio_dest = self.preparar_audio_ffmpeg(audio_path)
+            self.transcribir_audio(pcm_16k)
+            return audio_dest
+        if self.config.modo_audio == "memoria":
+            # Una sola decodificación compartida por silencios, asset y Whisper
+            audio = self.eliminar_silencios_pcm(AudioDecodificado.decodificar(audio_path))
+            audio_dest = self.exportar_asset(audio)
+            self.transcribir_audio(audio.pcm_16k)
+            return audio_dest
+        audio_sin_silencios = self.eliminar_silencios(audio_path)
         try:
-            audio_path = archivo_audio or self.obtener_archivo_audio()
-            self.print_status(f"Procesando archivo: {os.path.basename(audio_path)}", "🎙")
-            audio_sin_silencios = self.eliminar_silencios(audio_path)
             audio_dest = self.copiar_audio(audio_sin_silencios)
             self.transcribir_audio(audio_dest)
-            
+        finally:
+            # Limpieza: eliminar el archivo de audio sin silencios
+            if os.path.exists(audio_sin_silencios):
+                os.remove(audio_sin_silencios)
+        return audio_dest
+    
+    async def analizar_y_exportar(self, audio_dest):
+        """Etapa de GPT y exportación a partir de una transcripción ya hecha."""
+        if self.config.pipeline_concurrente:
+            # La segmentación no espera al análisis del guion; solo la fase visual necesita ambos
+            await asyncio.gather(
+                self.analizar_texto_completo(),
+                self.segmentar_con_gpt(usar_analisis=False, analisis_visual=False)
+            )
+            await self.analizar_visual_segmentos()
+        else:
             # Primero realizamos el análisis completo del guion
             analisis_guion = await self.analizar_texto_completo()
             
             # Luego continuamos con la segmentación y el resto del proceso
             await self.segmentar_con_gpt()
-            
-            # Convertir los segmentos procesados en objetos Segmento y agregarlos al proyecto
-            for seg_dict in self.segmentos_procesados:
-                seg = Segmento()
-                seg.texto = seg_dict.get('texto', '')
-                seg.tiempo_inicio = seg_dict.get('tiempo_inicio', 0.0)
-                seg.tiempo_fin = seg_dict.get('tiempo_fin', 0.0)
-                seg.score_matching = seg_dict.get('score_matching', 0.0)
-                seg.descripcion_visual = seg_dict.get('descripcion_visual', '')
-                seg.storyboard = seg_dict.get('storyboard', "")
-                seg.tipo_visual = seg_dict.get('tipo_visual', {})
-                seg.palabras_clave = seg_dict.get('palabras_clave', [])
-                self.proyecto.segmentos.append(seg)
-            
-            self.proyecto.actualizar_metadata()
-            self.generar_srt_nuevo()
-            self.generar_xml_nuevo(audio_dest)
-            self.print_status("¡Proceso completado exitosamente!", "🎉")
+        
+        # Convertir los segmentos procesados en objetos Segmento y agregarlos al proyecto
+        for seg_dict in self.segmentos_procesados:
+            seg = Segmento()
+            seg.texto = seg_dict.get('texto', '')
+            seg.tiempo_inicio = seg_dict.get('tiempo_inicio', 0.0)
+            seg.tiempo_fin = seg_dict.get('tiempo_fin', 0.0)
+            seg.score_matching = seg_dict.get('score_matching', 0.0)
+            seg.descripcion_visual = seg_dict.get('descripcion_visual', '')
+            seg.storyboard = seg_dict.get('storyboard', "")
+            seg.tipo_visual = seg_dict.get('tipo_visual', {})
+            seg.palabras_clave = seg_dict.get('palabras_clave', [])
+            self.proyecto.segmentos.append(seg)
+        
+        self.proyecto.actualizar_metadata()
+        self.proyecto.construir_marcadores()
+        self.generar_srt_nuevo()
+        self.generar_xml_nuevo(audio_dest)
+        self.print_status("¡Proceso completado exitosamente!", "🎉")
+        return self.xml_path, self.srt_path
+
+    async def procesar_audio(self, archivo_audio=None):
+        """Proceso completo: desde la preparación del audio hasta la generación de SRT y XML."""
+        self.print_status("Iniciando procesamiento...", "🚀")
+        self.iniciar_registro()
+        try:
+            audio_path = archivo_audio or self.obtener_archivo_audio()
+            audio_dest = self.preparar_y_transcribir(audio_path)
+            await self.analizar_y_exportar(audio_dest)
         except Exception as e:
-            self.print_status(f"Error en el procesamiento: {str(e)}", "❌")
-            with open(self.gpt_analysis_path, 'a', encoding='utf-8') as f:
-                f.write("\n=== ERROR EN EL PROCESAMIENTO ===\n")
-                f.write(f"Error: {str(e)}\n")
+            self.registrar_error(e)
             raise
-        finally:
-            # Limpieza: eliminar el archivo de audio sin silencios
-            if 'audio_sin_silencios' in locals() and os.path.exists(audio_sin_silencios):
-                os.remove(audio_sin_silencios)
         return self.xml_path, self.srt_path
 
     def get_ffmpeg_path(self):
@@ -1119,12 +2843,98 @@ Devuelve solo JSON válido con el siguiente formato:
             # Para Windows u otros sistemas
             return 'ffmpeg', 'ffprobe'
 
+# ============================================================
+# Procesamiento por lotes
+# ============================================================
+async def procesar_lote(entradas, audio_folder=None, config=None, max_en_analisis=4):
+    """Procesa una carpeta o patrón glob solapando etapas entre archivos.
+
+    La transcripción (CPU) se hace de un archivo en cada vez en un hilo aparte,
+    mientras hasta max_en_analisis archivos ya transcritos avanzan por las fases de GPT.
+    Devuelve una lista de (archivo, (xml_path, srt_path) o la excepción producida)."""
+    archivos = MoodboardSimple.listar_archivos_audio(entradas)
+    config = config if config else ConfiguracionPipeline()
+    loop = asyncio.get_running_loop()
+    cola = asyncio.Queue(maxsize=max_en_analisis)
+    resultados = {}
+    logger.info(f"📦 Lote de {len(archivos)} archivos")
+
+    async def etapa_audio():
+        motor = None  # Se reutiliza el modelo cargado entre archivos
+        for archivo in archivos:
+            moodboard = MoodboardSimple(audio_folder=audio_folder, whisper_model=motor, config=config)
+            moodboard.iniciar_registro()
+            try:
+                audio_dest = await loop.run_in_executor(
+                    moodboard.presupuesto.ejecutor(), moodboard.preparar_y_transcribir, archivo
+                )
+                motor = moodboard._motor
+                await cola.put((archivo, moodboard, audio_dest))
+            except Exception as e:
+                moodboard.registrar_error(e)
+                resultados[archivo] = e
+        for _ in range(max_en_analisis):
+            await cola.put(None)
+
+    async def etapa_gpt():
+        while (trabajo := await cola.get()) is not None:
+            archivo, moodboard, audio_dest = trabajo
+            try:
+                resultados[archivo] = await moodboard.analizar_y_exportar(audio_dest)
+            except Exception as e:
+                moodboard.registrar_error(e)
+                resultados[archivo] = e
+
+    await asyncio.gather(etapa_audio(), *[etapa_gpt() for _ in range(max_en_analisis)])
+    return [(archivo, resultados[archivo]) for archivo in archivos]
+
 # ============================================================
 # Ejemplo de uso
 # ============================================================
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Genera XML y SRT con marcadores a partir de voice-overs.")
+    parser.add_argument("entradas", nargs="*",
+                        help="Archivos, carpetas o patrones glob. Sin entradas se procesa el primer audio de la carpeta de salida.")
+    parser.add_argument("--salida", default=None, help="Carpeta donde se crean los proyectos")
+    parser.add_argument("--modo-audio", choices=["pydub", "memoria", "ffmpeg"], default="pydub")
+    parser.add_argument("--motor", default=os.getenv("MOTOR_TRANSCRIPCION", "whisper"),
+                        choices=sorted(MOTORES_TRANSCRIPCION))
+    parser.add_argument("--workers", default="1", help='Procesos de transcripción (número o "auto")')
+    parser.add_argument("--concurrente", action="store_true",
+                        help="Segmenta en paralelo con el análisis del guion")
+    parser.add_argument("--protocolo", choices=["texto", "indices"], default="texto",
+                        help="Formato de respuesta de la segmentación")
+    parser.add_argument("--formato-transcripcion", choices=["json", "npz"], default="json",
+                        help="Formato del artefacto de transcripción en analysis/")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Recibe el análisis visual en streaming, segmento a segmento")
+    parser.add_argument("--refrescar-cache-gpt", action="store_true",
+                        help="Ignora las respuestas de GPT cacheadas (las nuevas se siguen guardando)")
+    parser.add_argument("--en-analisis", type=int, default=4, help="Archivos en fases de GPT a la vez (lotes)")
+    args = parser.parse_args()
+
+    config = ConfiguracionPipeline(
+        modo_audio=args.modo_audio,
+        motor_transcripcion=args.motor,
+        workers_transcripcion=args.workers if args.workers == "auto" else int(args.workers),
+        pipeline_concurrente=args.concurrente,
+        refrescar_cache_gpt=args.refrescar_cache_gpt,
+        streaming_gpt=args.streaming,
+        protocolo_segmentacion=args.protocolo,
+        formato_transcripcion=args.formato_transcripcion
+    )
+
     async def main():
-        moodboard = MoodboardSimple()
+        if args.entradas:
+            for archivo, resultado in await procesar_lote(args.entradas, args.salida, config, args.en_analisis):
+                if isinstance(resultado, Exception):
+                    logger.info(f"❌ {os.path.basename(archivo)}: {resultado}")
+                else:
+                    logger.info(f"✅ {os.path.basename(archivo)}: {resultado[0]}")
+            return
+        moodboard = MoodboardSimple(audio_folder=args.salida, config=config)
         xml_path, srt_path = await moodboard.procesar_audio()
         logger.info(f"XML generado en: {xml_path}")
         logger.info(f"SRT generado en: {srt_path}")
@@ -9,11 +9,11 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout
                             QDialog, QLineEdit, QInputDialog, QMessageBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QIcon, QAction, QPalette, QColor, QFontDatabase
-from Sound_to_XML import MoodboardSimple
-import whisper
+from Sound_to_XML import MoodboardSimple, ConfiguracionPipeline, crear_motor_transcripcion, MotorWhisper
 from openai import OpenAI, AsyncOpenAI
 import subprocess
 import platform
+import multiprocessing
 from dotenv import load_dotenv
 import socket
 
@@ -28,7 +28,17 @@ class WhisperModelLoader:
     @classmethod
     def get_model(cls):
         if cls._model is None:
-            cls._model = whisper.load_model("small")
+            # El motor se elige con la variable MOTOR_TRANSCRIPCION (whisper por defecto);
+            # MODELO_CUANTIZADO=1 usa la copia int8 cacheada para arrancar más rápido
+            opciones = {}
+            if os.getenv("MODELO_CUANTIZADO"):
+                opciones["cuantizado"] = os.getenv("MODELO_CUANTIZADO") == "1"
+            motor = crear_motor_transcripcion(os.getenv("MOTOR_TRANSCRIPCION", "whisper"), "small", **opciones)
+            # MotorWhisper carga los pesos de forma perezosa; se fuerza aquí para que la precarga
+            # en segundo plano deje el modelo listo antes del primer trabajo
+            if isinstance(motor, MotorWhisper):
+                motor.modelo
+            cls._model = motor
         return cls._model
 
 class AsyncProcessor(QThread):
@@ -47,9 +57,12 @@ class AsyncProcessor(QThread):
         try:
             moodboard = MoodboardSimple(
                 audio_folder=self.output_folder,
-                whisper_model=self.model
+                whisper_model=self.model,
+                config=ConfiguracionPipeline(streaming_gpt=True)
             )
             moodboard.print_status = lambda msg, emoji="ℹ️": self.progress_signal.emit(f"{emoji} {msg}")
+            moodboard.al_marcador_parcial = lambda indice, segmento, analisis: self.progress_signal.emit(
+                f"🎬 Marcador {indice + 1} ({segmento['tiempo_inicio']:.2f}s): {segmento['texto'][:60]}")
             xml_path, srt_path = await moodboard.procesar_audio(self.audio_path)
             return xml_path, srt_path
         except Exception as e:
@@ -669,4 +682,6 @@ def main():
         sock.close()
 
 if __name__ == "__main__":
+    # Necesario para el pool de transcripción en ejecutables congelados (PyInstaller)
+    multiprocessing.freeze_support()
     main() 
\ No newline at end of file